@@ -4,13 +4,48 @@ import json
 import boto3
 import time
 import subprocess
+from collections import deque
 from pathlib import Path
+from botocore.exceptions import ClientError, HTTPClientError
+
+DIAG_DIR = Path('/home/runner/_diag')
+DIAG_LOG_PATTERNS = ('Runner_*.log', 'Worker_*.log')
+WORKFLOW_MARKER = 'WorkflowJobRequestId:'
+READ_CHUNK_SIZE = 1024 * 1024
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26
+MAX_EVENT_BYTES = 262144 - EVENT_OVERHEAD_BYTES
+LOG_GROUP_PREFIX = '/github-runners/'
+CACHE_TTL = 3600
+# Failed batches kept for retry; the oldest are dropped past this
+MAX_UNSENT_BATCHES = 100
 
 class GitHubLogForwarder:
     def __init__(self):
         self.cloudwatch = boto3.client('logs')
         self.current_workflow_id = None
         self.log_group = None
+        self.detected_workflow = None
+        # Byte offset and trailing partial line per followed diag log
+        self.offsets = {}
+        # Expiry time of log groups/streams known to exist, keyed by (group, stream)
+        self.known_resources = {}
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_stream = None
+        # (log group, stream, events) batches not yet accepted by CloudWatch
+        self.unsent = deque()
+        self.warm_cache()
+        # Logs already present at startup are followed from their current end;
+        # only the newest Runner log is scanned for the workflow in progress
+        log_files = self.diag_logs()
+        runner_logs = [log_file for log_file in log_files if log_file.name.startswith('Runner_')]
+        for log_file in log_files:
+            if runner_logs and log_file == runner_logs[-1]:
+                self.scan_for_workflow(log_file)
+            else:
+                self.offsets[str(log_file)] = (log_file.stat().st_size, b'')
         
     def get_workflow_info(self):
         """Extract workflow information from environment or runner logs"""
@@ -31,58 +66,194 @@ class GitHubLogForwarder:
         return self.parse_from_logs()
     
     def parse_from_logs(self):
-        """Parse workflow info from runner diagnostic logs"""
+        """
+        Workflow info detected from runner diagnostic logs. forward_logs spots
+        workflow changes in the lines it streams, so nothing is re-read here.
+        """
+        return self.detected_workflow
+
+    def workflow_from_line(self, line):
+        workflow_id = line.split(':')[-1].strip()
+        return {
+            'workflow_id': workflow_id,
+            'repository': 'parsed-from-logs',
+            'runner_name': os.environ.get('HOSTNAME', 'unknown'),
+            'log_group': f"/github-runners/parsed/{workflow_id}"
+        }
+
+    def scan_for_workflow(self, log_file):
+        """Pick up the last workflow marker in an existing log, one chunk at a time"""
+        marker = WORKFLOW_MARKER.encode('utf-8')
+        offset = 0
+        partial = b''
+        with open(log_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+                offset += len(chunk)
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                for raw_line in lines:
+                    if marker in raw_line:
+                        self.detected_workflow = self.workflow_from_line(raw_line.decode('utf-8', errors='replace'))
+        self.offsets[str(log_file)] = (offset, partial)
+
+    def diag_logs(self):
+        if not DIAG_DIR.exists():
+            return []
+        log_files = []
+        for pattern in DIAG_LOG_PATTERNS:
+            for log_file in DIAG_DIR.glob(pattern):
+                try:
+                    log_files.append((log_file.stat().st_mtime, log_file))
+                except FileNotFoundError:
+                    # Rotated away since the glob
+                    pass
+        return [log_file for _, log_file in sorted(log_files)]
+
+    def is_known(self, log_group_name, log_stream_name=None):
+        return self.known_resources.get((log_group_name, log_stream_name), 0) > time.time()
+
+    def remember(self, log_group_name, log_stream_name=None):
+        self.known_resources[(log_group_name, log_stream_name)] = time.time() + CACHE_TTL
+
+    def warm_cache(self):
+        """Cache every existing runner log group with one paginated describe"""
         try:
-            log_dir = Path('/home/runner/_diag')
-            if log_dir.exists():
-                log_files = sorted(log_dir.glob('Runner_*.log'), key=os.path.getmtime, reverse=True)
-                if log_files:
-                    latest_log = log_files[0]
-                    with open(latest_log, 'r') as f:
-                        content = f.read()
-                        # Extract workflow information from log content
-                        # This is a simplified example - actual parsing would be more robust
-                        if 'WorkflowJobRequestId:' in content:
-                            lines = content.split('\n')
-                            for line in lines:
-                                if 'WorkflowJobRequestId:' in line:
-                                    workflow_id = line.split(':')[-1].strip()
-                                    return {
-                                        'workflow_id': workflow_id,
-                                        'repository': 'parsed-from-logs',
-                                        'runner_name': os.environ.get('HOSTNAME', 'unknown'),
-                                        'log_group': f"/github-runners/parsed/{workflow_id}"
-                                    }
+            paginator = self.cloudwatch.get_paginator('describe_log_groups')
+            for page in paginator.paginate(logGroupNamePrefix=LOG_GROUP_PREFIX):
+                for group in page['logGroups']:
+                    self.remember(group['logGroupName'])
         except Exception as e:
-            print(f"Error parsing logs: {e}")
-        
-        return None
-    
+            print(f"Error warming log group cache: {e}")
+
     def ensure_log_group(self, log_group_name):
         """Create log group if it doesn't exist"""
-        try:
-            self.cloudwatch.describe_log_groups(logGroupNamePrefix=log_group_name)
-        except self.cloudwatch.exceptions.ResourceNotFoundException:
-            self.cloudwatch.create_log_group(logGroupName=log_group_name)
+        if self.is_known(log_group_name):
+            return
+        groups = self.cloudwatch.describe_log_groups(logGroupNamePrefix=log_group_name)['logGroups']
+        if not any(group['logGroupName'] == log_group_name for group in groups):
+            try:
+                self.cloudwatch.create_log_group(logGroupName=log_group_name)
+            except self.cloudwatch.exceptions.ResourceAlreadyExistsException:
+                pass
             self.cloudwatch.put_retention_policy(
                 logGroupName=log_group_name,
                 retentionInDays=7
             )
+        self.remember(log_group_name)
     
+    def switch_workflow(self, workflow_info):
+        # The group is created with the first batch sent to it, so a failed
+        # create is retried along with that batch
+        self.current_workflow_id = workflow_info['workflow_id']
+        self.log_group = workflow_info['log_group']
+        print(f"Forwarding logs for workflow {self.current_workflow_id} to {self.log_group}")
+
+    def ensure_log_stream(self, log_group_name, log_stream_name):
+        """Create the log stream in log_group_name the first time it is used"""
+        if self.is_known(log_group_name, log_stream_name):
+            return
+        try:
+            self.cloudwatch.create_log_stream(logGroupName=log_group_name, logStreamName=log_stream_name)
+        except self.cloudwatch.exceptions.ResourceAlreadyExistsException:
+            pass
+        self.remember(log_group_name, log_stream_name)
+
+    def forward_logs(self):
+        """
+        Follow the runner diag logs by byte offset and push newly appended lines
+        to the current workflow's log group. Only bytes written since the last
+        call are read, in bounded chunks, so memory use does not depend on log size.
+        A file that can't be read is skipped until the next call.
+        """
+        log_files = self.diag_logs()
+        for log_file in log_files:
+            try:
+                self.follow(log_file)
+            except OSError as e:
+                print(f"Error reading {log_file}: {e}")
+        # Forget the offsets of logs that have been removed
+        current = {str(log_file) for log_file in log_files}
+        for path in [path for path in self.offsets if path not in current]:
+            del self.offsets[path]
+
+    def follow(self, log_file):
+        path = str(log_file)
+        offset, partial = self.offsets.get(path, (0, b''))
+        while True:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            offset += len(chunk)
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+            for raw_line in lines:
+                self.handle_line(log_file.stem, raw_line.decode('utf-8', errors='replace').rstrip())
+            # Saved per chunk, so a read error later on doesn't resend these lines
+            self.offsets[path] = (offset, partial)
+        self.flush()
+
+    def handle_line(self, log_stream_name, line):
+        if WORKFLOW_MARKER in line:
+            self.detected_workflow = self.workflow_from_line(line)
+            if self.detected_workflow['workflow_id'] != self.current_workflow_id and not os.environ.get('GITHUB_RUN_ID'):
+                # Lines so far belong to the previous workflow's group
+                self.flush()
+                self.switch_workflow(self.detected_workflow)
+
+        if not line or not self.log_group:
+            return
+        data = line.encode('utf-8')
+        if len(data) > MAX_EVENT_BYTES:
+            line = data[:MAX_EVENT_BYTES].decode('utf-8', errors='ignore')
+            data = line.encode('utf-8')
+        size = len(data) + EVENT_OVERHEAD_BYTES
+        if log_stream_name != self.pending_stream or len(self.pending) == MAX_BATCH_EVENTS \
+                or self.pending_bytes + size > MAX_BATCH_BYTES:
+            self.flush()
+            self.pending_stream = log_stream_name
+        self.pending.append({'timestamp': int(time.time() * 1000), 'message': line})
+        self.pending_bytes += size
+
+    def flush(self):
+        """
+        Send buffered lines to the current log group, after any batches that
+        failed before. A batch CloudWatch doesn't accept stays queued, in
+        order, and is retried on the next flush.
+        """
+        if self.pending:
+            self.unsent.append((self.log_group, self.pending_stream, self.pending))
+            self.pending = []
+            self.pending_bytes = 0
+        while len(self.unsent) > MAX_UNSENT_BATCHES:
+            log_group_name, log_stream_name, events = self.unsent.popleft()
+            print(f"Dropping {len(events)} unsent lines for {log_group_name}/{log_stream_name}")
+        while self.unsent:
+            log_group_name, log_stream_name, events = self.unsent[0]
+            try:
+                self.ensure_log_group(log_group_name)
+                self.ensure_log_stream(log_group_name, log_stream_name)
+                self.cloudwatch.put_log_events(
+                    logGroupName=log_group_name,
+                    logStreamName=log_stream_name,
+                    logEvents=events
+                )
+            except (ClientError, HTTPClientError) as e:
+                print(f"Error sending logs to {log_group_name}/{log_stream_name}, will retry: {e}")
+                return
+            self.unsent.popleft()
+
     def start_forwarding(self):
         """Main forwarding loop"""
         while True:
             workflow_info = self.get_workflow_info()
             
             if workflow_info and workflow_info['workflow_id'] != self.current_workflow_id:
-                self.current_workflow_id = workflow_info['workflow_id']
-                self.log_group = workflow_info['log_group']
-                self.ensure_log_group(self.log_group)
-                print(f"Forwarding logs for workflow {self.current_workflow_id} to {self.log_group}")
+                self.switch_workflow(workflow_info)
             
-            # Forward logs if we have an active workflow
-            if self.log_group:
-                self.forward_logs()
+            # Always follow the diag logs: workflow changes are detected from them
+            self.forward_logs()
             
             time.sleep(5)
 
@@ -1,161 +1,209 @@
 import os
 import time
-import re
+import gzip
+import json
+import random
+import itertools
 import logging
-from datetime import datetime
-import boto3
-from botocore.exceptions import ClientError
+import threading
+from botocore.exceptions import ClientError, HTTPClientError
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-LOG_DIR = "/actions-runner/_diag"
-LOG_GROUP = "/var/log"
-REGION = "us-east-2"
+from logupload import (LOG_DIR, UploadDispatcher, checkpoints, ensure_log_stream, follow_and_upload, lanes, log,
+                       mark_processed, pack_batches, processed_files, put_batch, stream_cache)
 
-client = boto3.client("logs", region_name=REGION)
-
-# Keep track of already processed files
-processed_files = set()
+UNKNOWN_RUN_ID = "unknown-run-id"
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "uploader_spool")
+SPOOL_BASE_DELAY = 1
+SPOOL_MAX_DELAY = 60
+RETRYABLE_ERROR_CODES = {"ThrottlingException", "ServiceUnavailableException", "InternalFailure"}
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 
 
-def log(msg, level="info"):
-    """Helper for consistent log formatting"""
-    if level == "error":
-        logging.error(msg)
-    elif level == "warn":
-        logging.warning(msg)
-    else:
-        logging.info(msg)
+def error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get("Error", {}).get("Code", "Unknown")
+    return type(e).__name__
 
 
-def ensure_log_stream(run_id):
-    """Ensure log stream exists for this run_id"""
-    try:
-        client.create_log_stream(logGroupName=LOG_GROUP, logStreamName=str(run_id))
-        log(f"Created log stream: {run_id}")
-    except client.exceptions.ResourceAlreadyExistsException:
-        log(f"Log stream already exists: {run_id}")
+def is_retryable(e):
+    """Throttling, server-side failures and connection problems are worth retrying"""
+    return isinstance(e, HTTPClientError) or error_code(e) in RETRYABLE_ERROR_CODES
 
 
-def extract_run_id(file_path):
-    """Extract run_id from log content using regex"""
-    pattern = re.compile(r'"k"\s*:\s*"run_id"\s*,\s*"v"\s*:\s*"(\d+)"', re.MULTILINE)
-    try:
-        with open(file_path, "r") as f:
-            content = f.read()
-        match = pattern.search(content)
-        if match:
-            run_id = match.group(1)
-            log(f"Found run_id: {run_id} in {file_path}")
-            return run_id
-        else:
-            log(f"⚠️ run_id not found in {file_path}", "warn")
-            return "unknown-run-id"
-    except Exception as e:
-        log(f"❌ Error reading {file_path} for run_id: {e}", "error")
-        return "unknown-run-id"
-
-
-def wait_for_job_completed(file_path, timeout=300, interval=5):
-    """Wait until 'Job completed.' appears in the file, or timeout reached"""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
+def put_events(run_id, log_events, sequence_token=None):
+    """
+    Send log_events to the run_id stream in packed batches, returning the next
+    sequence token. When CloudWatch throttles or is unreachable, or the spool
+    still holds a backlog, batches are spooled to disk instead of being lost.
+    """
+    log_events = sorted(log_events, key=lambda event: event["timestamp"])
+    for batch in pack_batches(log_events):
+        if spool.has_backlog():
+            spool.add(run_id, batch)
+            continue
         try:
-            with open(file_path, "r") as f:
-                content = f.read()
-                if "Job completed." in content:
-                    log(f"'Job completed.' found in {file_path}")
-                    return True
-        except Exception as e:
-            log(f"❌ Error reading {file_path}: {e}", "error")
-        time.sleep(interval)
-    log(f"⚠️ Timeout waiting for 'Job completed.' in {file_path}", "warn")
-    return False
-
-
-def upload_file_to_cloudwatch(file_path, run_id):
-    """Upload entire log file contents to CloudWatch Logs"""
-    ensure_log_stream(run_id)
-
+            sequence_token = put_batch(run_id, batch, sequence_token)
+        except (ClientError, HTTPClientError) as e:
+            if not is_retryable(e):
+                raise
+            log(f"⏳ CloudWatch unavailable ({error_code(e)}), spooling {len(batch)} events for stream {run_id}", "warn")
+            spool.add(run_id, batch)
+    return sequence_token
+
+
+class UploadSpool:
+    """
+    On-disk spool of put_log_events batches that could not be sent because
+    CloudWatch was throttling or unreachable. Each batch is written as a gzip
+    compressed JSON segment; a replayer thread sends segments oldest first with
+    exponential backoff and deletes each once accepted. Only one segment is held
+    in memory at a time, and segments left behind are replayed after a restart.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        os.makedirs(spool_dir, exist_ok=True)
+        for name in os.listdir(spool_dir):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(spool_dir, name))
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.counter = itertools.count()
+        self.backlog = len(self.segments())
+        self.thread = None
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(".json.gz"))
+
+    def has_backlog(self):
+        return self.backlog > 0
+
+    def add(self, run_id, batch):
+        name = f"{time.time_ns():020d}-{next(self.counter):08d}.json.gz"
+        path = os.path.join(self.spool_dir, name)
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump({"run_id": run_id, "events": batch}, f)
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.backlog += 1
+        self.wakeup.set()
+
+    def start(self):
+        if self.backlog:
+            log(f"📦 Replaying {self.backlog} spooled batches from {self.spool_dir}")
+        self.thread = threading.Thread(target=self._replay, name="spool-replayer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+
+    def _send(self, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            segment = json.load(f)
+        try:
+            put_batch(segment["run_id"], segment["events"])
+        except ClientError as e:
+            if error_code(e) != "ResourceNotFoundException":
+                raise
+            stream_cache.discard(str(segment["run_id"]))
+            ensure_log_stream(segment["run_id"])
+            put_batch(segment["run_id"], segment["events"])
+
+    def _replay(self):
+        delay = SPOOL_BASE_DELAY
+        while not self.stopped.is_set():
+            segments = self.segments()
+            if not segments:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            for name in segments:
+                if self.stopped.is_set():
+                    return
+                path = os.path.join(self.spool_dir, name)
+                try:
+                    self._send(path)
+                except (ClientError, HTTPClientError) as e:
+                    if is_retryable(e):
+                        log(f"⏳ Spool replay got {error_code(e)}, retrying in {delay}s", "warn")
+                        self.stopped.wait(delay + random.uniform(0, delay / 2))
+                        delay = min(delay * 2, SPOOL_MAX_DELAY)
+                        break
+                    log(f"❌ Giving up on spooled batch {name}: {e}", "error")
+                    os.replace(path, path + ".failed")
+                except (OSError, ValueError) as e:
+                    log(f"❌ Unreadable spooled batch {name}: {e}", "error")
+                    os.replace(path, path + ".failed")
+                else:
+                    os.remove(path)
+                    delay = SPOOL_BASE_DELAY
+                with self.lock:
+                    self.backlog -= 1
+
+
+spool = UploadSpool(SPOOL_DIR)
+
+
+def process_worker_log(file_path):
+    """Upload one Worker log; a read or upload error leaves it unprocessed so it is retried"""
     try:
-        with open(file_path, "r") as f:
-            lines = f.readlines()
-    except Exception as e:
-        log(f"❌ Failed to read {file_path}: {e}", "error")
-        return
-
-    if not lines:
-        log(f"⚠️ File {file_path} is empty, skipping upload", "warn")
+        follow_and_upload(file_path, put_events, fallback_run_id=UNKNOWN_RUN_ID)
+    except OSError as e:
+        log(f"❌ Error reading {file_path}: {e}", "error")
         return
-
-    ts = int(time.time() * 1000)
-    log_events = [{"timestamp": ts, "message": line.strip()} for line in lines if line.strip()]
-
-    BATCH_SIZE = 10000
-    sequence_token = None
-
-    try:
-        for i in range(0, len(log_events), BATCH_SIZE):
-            batch = log_events[i:i + BATCH_SIZE]
-            kwargs = {
-                "logGroupName": LOG_GROUP,
-                "logStreamName": str(run_id),
-                "logEvents": batch,
-            }
-            if sequence_token:
-                kwargs["sequenceToken"] = sequence_token
-            resp = client.put_log_events(**kwargs)
-            sequence_token = resp.get("nextSequenceToken")
-
-        log(f"✅ Uploaded {len(log_events)} lines from {file_path} -> stream {run_id}")
-        processed_files.add(file_path)
     except ClientError as e:
         log(f"❌ Failed to upload {file_path} to CloudWatch: {e}", "error")
         # Here you can add SNS or email notification
         # Example: boto3.client("sns").publish(TopicArn="...", Message=str(e), Subject="Log upload failed")
+        return
+    mark_processed(file_path)
 
 
 class WorkerLogHandler(FileSystemEventHandler):
+    def __init__(self, dispatcher):
+        super().__init__()
+        self.dispatcher = dispatcher
+
     def on_created(self, event):
         if event.is_directory:
             return
         file_name = os.path.basename(event.src_path)
         if "Worker_" in file_name and event.src_path not in processed_files:
             log(f"📂 New Worker log detected: {event.src_path}")
-            time.sleep(2)  # wait briefly for file to stabilize
-
-            if wait_for_job_completed(event.src_path):
-                run_id = extract_run_id(event.src_path)
-                upload_file_to_cloudwatch(event.src_path, run_id)
-            else:
-                log(f"⚠️ Skipping {event.src_path} as 'Job completed.' not found", "warn")
-                processed_files.add(event.src_path)
+            self.dispatcher.submit(event.src_path)
 
 
-def process_existing_files():
+def process_existing_files(dispatcher):
     """Process files already present in LOG_DIR"""
     for file_name in os.listdir(LOG_DIR):
         file_path = os.path.join(LOG_DIR, file_name)
         if file_path in processed_files:
             continue
         if "Worker_" in file_name:
-            log(f"🔄 Processing existing Worker log: {file_path}")
-            if wait_for_job_completed(file_path):
-                run_id = extract_run_id(file_path)
-                upload_file_to_cloudwatch(file_path, run_id)
-            else:
-                log(f"⚠️ Skipping {file_path} as 'Job completed.' not found", "warn")
+            checkpoint = checkpoints.load(file_path)
+            if checkpoint and checkpoint["done"]:
                 processed_files.add(file_path)
+                continue
+            log(f"🔄 Processing existing Worker log: {file_path}")
+            dispatcher.submit(file_path)
 
 
 def main():
     log(f"🚀 Starting Worker log uploader, watching directory: {LOG_DIR}")
-    process_existing_files()
+    stream_cache.warm()
+    spool.start()
+    dispatcher = UploadDispatcher(process_worker_log)
+    process_existing_files(dispatcher)
 
-    event_handler = WorkerLogHandler()
+    event_handler = WorkerLogHandler(dispatcher)
     observer = Observer()
     observer.schedule(event_handler, LOG_DIR, recursive=False)
     observer.start()
@@ -167,6 +215,9 @@ def main():
         log("🛑 Stopping Worker log uploader...")
         observer.stop()
     observer.join()
+    dispatcher.shutdown()
+    lanes.shutdown()
+    spool.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,300 @@
+import contextlib
+import fcntl
+import glob
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# The columnar backend is optional: SQLite stays the default and these are only
+# needed when ANALYTICS_BACKEND=duckdb
+try:
+    import duckdb
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    duckdb = None
+
+ANALYTICS_BACKEND = os.environ.get("ANALYTICS_BACKEND", "sqlite")
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR", "analytics")
+# Rows per Parquet write when rebuilding a store from SQLite
+REBUILD_BATCH_SIZE = 100000
+# A partition with this many files is merged into one when a write publishes to it
+COMPACT_FILES = 16
+# Seconds a superseded version is kept for queries still reading it
+VERSION_GRACE_SECONDS = 300
+
+# Column order of the rows handed to StagedWrites.append
+COLUMNS = ['month_key', 'clientid', 'mal_code', 'uri', 'count', 'business_function', 'client_name']
+
+def partition_dir(root, month_key):
+    return os.path.join(root, f'year={month_key // 100}', f'month={month_key % 100}')
+
+def parquet_schema():
+    # Fixed types, so a batch whose names are all NULL still merges with the rest
+    return pa.schema([('month_key', pa.int64()), ('clientid', pa.string()), ('mal_code', pa.string()),
+                      ('uri', pa.string()), ('count', pa.int64()), ('business_function', pa.string()),
+                      ('client_name', pa.string())])
+
+def parquet_files(root):
+    return sorted(glob.glob(os.path.join(root, '**', '*.parquet'), recursive=True))
+
+def write_rows(root, rows):
+    """
+    Write rows (tuples in COLUMNS order) as new files in their year/month
+    partitions under root. Rows with no month_key have no partition to go in
+    and are skipped, as they are in the SQLite rollup.
+    """
+    rows = [row for row in rows if row[0] is not None]
+    if not rows:
+        return
+    table = pa.Table.from_pylist([dict(zip(COLUMNS, row)) for row in rows], schema=parquet_schema())
+    month_key = table.column('month_key').to_pylist()
+    table = table.append_column('year', pa.array([key // 100 for key in month_key], pa.int32()))
+    table = table.append_column('month', pa.array([key % 100 for key in month_key], pa.int32()))
+    pq.write_to_dataset(table, root_path=root, partition_cols=['year', 'month'],
+                        basename_template='part-' + uuid.uuid4().hex + '-{i}.parquet')
+
+class StagedWrites:
+    """
+    Changes to a ColumnarStore made alongside a SQLite transaction. New files
+    are written under a staging directory next to the store, and nothing the
+    store's readers see changes until publish(), which is called once the
+    transaction has committed; discard() drops them after a rollback.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.root = os.path.join(store.root + '.staging', uuid.uuid4().hex)
+        self.drop_all = False
+        self.dropped_months = set()
+        self.renames = []
+
+    def append(self, rows):
+        write_rows(self.root, rows)
+
+    def clear(self):
+        """Empty the store on publish, including anything staged so far"""
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.drop_all = True
+
+    def replace_with(self, conn, table):
+        """Stage the current contents of a SQLite table as the store's whole contents, e.g. after a remap"""
+        self.clear()
+        cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM {table} WHERE month_key IS NOT NULL")
+        while True:
+            rows = cursor.fetchmany(REBUILD_BATCH_SIZE)
+            if not rows:
+                break
+            self.append(rows)
+
+    def replace_months(self, conn, table, month_keys):
+        """Stage the current rows of a SQLite table for month_keys as those months' whole contents"""
+        month_keys = list(month_keys)
+        for month_key in month_keys:
+            shutil.rmtree(partition_dir(self.root, month_key), ignore_errors=True)
+        self.dropped_months.update(month_keys)
+        if not month_keys:
+            return
+        cursor = conn.execute(f"SELECT {', '.join(COLUMNS)} FROM {table} WHERE month_key IN "
+                              f"({','.join(['?'] * len(month_keys))})", month_keys)
+        while True:
+            rows = cursor.fetchmany(REBUILD_BATCH_SIZE)
+            if not rows:
+                break
+            self.append(rows)
+
+    def rename(self, key_column, name_column, mapping, month_keys):
+        """On publish, set name_column from mapping {key: name} on the rows of month_keys whose key_column matches"""
+        self.renames.append((key_column, name_column, mapping,
+                             {os.path.relpath(partition_dir(self.root, month_key), self.root) for month_key in month_keys}))
+
+    def publish(self):
+        """
+        Build the store's next version from the current one and the staged
+        changes, then switch readers to it in one rename. Unchanged files are
+        hard links into the current version, which stays readable meanwhile.
+        """
+        current = self.store.current_version()
+        version = f'v{time.time_ns():020d}'
+        target = os.path.join(self.store.root, version)
+        dropped = {os.path.relpath(partition_dir(self.root, month_key), self.root) for month_key in self.dropped_months}
+        if current and not self.drop_all:
+            source = os.path.join(self.store.root, current)
+            for path in parquet_files(source):
+                relpath = os.path.relpath(path, source)
+                if os.path.dirname(relpath) not in dropped:
+                    os.makedirs(os.path.dirname(os.path.join(target, relpath)), exist_ok=True)
+                    os.link(path, os.path.join(target, relpath))
+        touched = set()
+        for path in parquet_files(self.root):
+            relpath = os.path.relpath(path, self.root)
+            touched.add(os.path.dirname(relpath))
+            os.makedirs(os.path.dirname(os.path.join(target, relpath)), exist_ok=True)
+            os.replace(path, os.path.join(target, relpath))
+        for key_column, name_column, mapping, partitions in self.renames:
+            for partition in partitions:
+                rename_rows(os.path.join(target, partition), key_column, name_column, mapping)
+        for partition in touched:
+            compact(os.path.join(target, partition))
+        os.makedirs(target, exist_ok=True)
+        self.store.set_current_version(version)
+        self.discard()
+
+    def discard(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+def rename_rows(partition, key_column, name_column, mapping):
+    """Rewrite the files of a partition that have keys in mapping, with those rows' names replaced"""
+    keys = pa.array(list(mapping), pa.string())
+    names = pa.array(list(mapping.values()), pa.string())
+    for path in parquet_files(partition):
+        table = pq.read_table(path, schema=parquet_schema())
+        index = pc.index_in(table.column(key_column), value_set=keys)
+        matched = pc.is_valid(index)
+        if not pc.any(matched).as_py():
+            continue
+        renamed = pc.if_else(matched, pc.take(names, index), table.column(name_column))
+        table = table.set_column(table.schema.get_field_index(name_column), name_column, renamed)
+        # Only this version's link to the old file goes; earlier versions keep theirs
+        pq.write_table(table, os.path.join(partition, 'part-' + uuid.uuid4().hex + '-0.parquet'))
+        os.remove(path)
+
+def compact(partition):
+    """Merge a partition's files into one once appends have left COMPACT_FILES or more"""
+    paths = parquet_files(partition)
+    if len(paths) < COMPACT_FILES:
+        return
+    table = pa.concat_tables(pq.read_table(path, schema=parquet_schema()) for path in paths)
+    pq.write_table(table, os.path.join(partition, 'part-' + uuid.uuid4().hex + '-0.parquet'))
+    for path in paths:
+        os.remove(path)
+
+class ColumnarStore:
+    """
+    Usage rows mirrored into Parquet files partitioned by year and month
+    (hive layout), with the dashboard aggregations answered by DuckDB.
+    Each write publishes a new version directory under root and then points
+    root/CURRENT at it, so queries only ever see whole versions. Writers,
+    in this process or another, publish one at a time under a file lock.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.conn = duckdb.connect()
+        self.write_lock = threading.Lock()
+        # (version, files) of the last version queried, so each query doesn't re-glob
+        self.listing = (None, [])
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the store's write lock across threads and processes"""
+        with self.write_lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.root + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def current_version(self):
+        try:
+            with open(os.path.join(self.root, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def set_current_version(self, version):
+        """Point readers at version, then remove versions superseded over VERSION_GRACE_SECONDS ago"""
+        pointer = os.path.join(self.root, 'CURRENT')
+        with open(pointer + '.tmp', 'w') as f:
+            f.write(version)
+        os.replace(pointer + '.tmp', pointer)
+        versions = sorted(name for name in os.listdir(self.root) if name.startswith('v'))
+        cutoff = time.time_ns() - VERSION_GRACE_SECONDS * 10 ** 9
+        for old, newer in zip(versions, versions[1:]):
+            # A version was superseded when the one after it was created
+            if old != version and int(newer[1:]) < cutoff:
+                shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+        # Files left directly under root by the unversioned layout
+        for name in os.listdir(self.root):
+            if name.startswith('year='):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def files(self):
+        version = self.current_version()
+        if self.listing[0] != version:
+            self.listing = (version, parquet_files(os.path.join(self.root, version)) if version else [])
+        return self.listing[1]
+
+    def is_empty(self):
+        return not self.files()
+
+    def query(self, sql, params=()):
+        files = self.files()
+        if not files:
+            return []
+        source = "read_parquet([{}], hive_partitioning = true)".format(
+            ', '.join("'{}'".format(path.replace("'", "''")) for path in files))
+        # A cursor per call, as DuckDB connections are not shared between threads
+        return self.conn.cursor().execute(sql.format(source=source), list(params)).fetchall()
+
+    def monthly_totals(self, start_key, end_key, client_names=None, business_functions=None):
+        """(month 'YYYY-MM', client_name, business_function, total_count) rows ordered by month"""
+        conditions = ['year BETWEEN ? AND ?', 'month_key BETWEEN ? AND ?']
+        params = [start_key // 100, end_key // 100, start_key, end_key]
+        if client_names is not None:
+            conditions.append('client_name IN ({})'.format(','.join(['?'] * len(client_names)) or 'NULL'))
+            params.extend(client_names)
+        if business_functions is not None:
+            conditions.append('business_function IN ({})'.format(','.join(['?'] * len(business_functions)) or 'NULL'))
+            params.extend(business_functions)
+        return self.query('''
+            SELECT printf('%04d-%02d', month_key // 100, month_key % 100), client_name, business_function,
+                   SUM(count)
+            FROM {source}
+            WHERE ''' + ' AND '.join(conditions) + '''
+            GROUP BY month_key, client_name, business_function
+            ORDER BY month_key
+        ''', params)
+
+    def distinct(self, column):
+        return [row[0] for row in self.query(f'SELECT DISTINCT {column} FROM {{source}}')]
+
+@contextlib.contextmanager
+def staged_transaction(conn, store):
+    """
+    A `with conn:` transaction whose mirror writes go through the yielded
+    StagedWrites (None when there is no store). They are published after the
+    commit and discarded if the transaction rolls back, so the mirror never
+    holds rows SQLite does not.
+    """
+    if store is None:
+        with conn:
+            yield None
+        return
+    # Taken before the SQLite write lock in every writer, so the two never deadlock
+    with store.locked():
+        staged = StagedWrites(store)
+        try:
+            with conn:
+                yield staged
+        except BaseException:
+            staged.discard()
+            raise
+        staged.publish()
+
+def open_store(name):
+    """
+    The ColumnarStore for one app's data when ANALYTICS_BACKEND=duckdb,
+    otherwise None so callers keep using SQLite.
+    """
+    if ANALYTICS_BACKEND != 'duckdb':
+        return None
+    if duckdb is None:
+        print("ANALYTICS_BACKEND=duckdb needs the duckdb and pyarrow packages; using SQLite")
+        return None
+    return ColumnarStore(os.path.join(ANALYTICS_DIR, name))
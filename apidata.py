@@ -1,17 +1,72 @@
-import sqlite3
+from dbpool import get_connection
+from analytics import open_store
+from chartseries import reduce_series
+from usagedb import QueryCache, StarSchema, setup_database, write_transaction, remap_dimension, load_csv, LOAD_CHUNK_SIZE
 import pandas as pd
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, Response
 import plotly.express as px
-import csv
+import json
 
 app = Flask(__name__)
 
+# Fields of the rows parse_csv_rows and frame_to_rows yield, kept as transaction_facts behind the
+# transactions view from migration 5 on; date is derived from month and year
+STAR_SCHEMA = StarSchema(
+    'transactions', 'transaction_facts',
+    ['month', 'year', 'clientid', 'mal_code', 'uri', 'count', 'business_function', 'client_name', 'date', 'month_key'],
+    {'month': 'INTEGER', 'year': 'INTEGER', 'count': 'INTEGER', 'month_key': 'INTEGER'},
+    {'date': "printf('%04d-%02d', f.year, f.month)"},
+)
+
+# Versioned schema changes applied at startup; entry N moves user_version to N
+SCHEMA_MIGRATIONS = [
+    # 1: integer YYYYMM month key so month ranges compare and sort as numbers
+    [
+        'ALTER TABLE transactions ADD COLUMN month_key INTEGER',
+        'UPDATE transactions SET month_key = CAST(year AS INTEGER) * 100 + CAST(month AS INTEGER)',
+    ],
+    # 2: covering index for /get_data, DISTINCT lists and the mapping updates
+    [
+        'CREATE INDEX IF NOT EXISTS idx_transactions_client_function_month '
+        'ON transactions (client_name, business_function, month_key, count)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_function ON transactions (business_function)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_clientid ON transactions (clientid)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_uri ON transactions (uri)',
+    ],
+    # 3: monthly rollup the chart queries read instead of the raw rows
+    [
+        '''CREATE TABLE IF NOT EXISTS monthly_rollup (
+            month_key INTEGER,
+            client_name TEXT,
+            business_function TEXT,
+            total_count INTEGER,
+            PRIMARY KEY (client_name, business_function, month_key)
+        ) WITHOUT ROWID''',
+        '''INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+        SELECT month_key, IFNULL(client_name, ''), IFNULL(business_function, ''), SUM(count)
+        FROM transactions
+        WHERE month_key IS NOT NULL
+        GROUP BY 1, 2, 3''',
+    ],
+    # 4: fingerprints of the CSV exports already loaded, for incremental startup
+    [
+        '''CREATE TABLE IF NOT EXISTS source_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            head_hash TEXT,
+            rows INTEGER
+        )''',
+    ],
+    *STAR_SCHEMA.migrations(),
+]
+
+query_cache = QueryCache('transactions.db')
+
 # Function to load data from CSV into SQLite
 def create_database():
-    conn = sqlite3.connect('transactions.db')
+    conn = get_connection('transactions.db')
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE transactions')
-    conn.commit()
     # Create the table with the necessary columns
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
@@ -27,52 +82,79 @@ def create_database():
         )
     ''')
     conn.commit()
-    conn.close()
-
-def load_data_from_csv(csv_file):
-    with open(csv_file, 'r') as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for row in csvreader:
-            month = row['month']
-            year = row['year']
-            clientid = row['clientid']
-            mal_code = row['mal_code']
-            uri = row['uri']
-            count = int(row['count'])
-            business_function = row['uri']   # Replace with actual data
-            client_name =  row['clientid']# Replace with actual data
-            date = f"{year}-{month.zfill(2)}"  # Combine year and month
-            print(date)
-            # Insert data into the SQLite database
-            conn = sqlite3.connect('transactions.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO transactions (month, year, clientid, mal_code, uri, count, business_function, client_name, date)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (month, year, clientid, mal_code, uri, count, business_function, client_name, date))
-            conn.commit()
-            cursor.execute('''
-                SELECT date, SUM(count) as total_count, client_name, business_function
-                FROM transactions
-                GROUP BY date, client_name, business_function
-                ORDER BY date
-            ''')
-            print('hii->',cursor.fetchall())
-            conn.close()
-
-
+    setup_database(conn, SCHEMA_MIGRATIONS, 'transactions', analytics_store)
+
+# Parquet/DuckDB mirror used for the dashboard aggregations when ANALYTICS_BACKEND=duckdb
+analytics_store = open_store('transactions')
+
+# Rows fetched per keyset page while streaming /get_transactions
+EXPORT_BATCH_SIZE = 5000
+
+def parse_csv_rows(csvreader):
+    """Yield transactions rows from a csv.reader positioned at the header line"""
+    header = next(csvreader)
+    column = {name: i for i, name in enumerate(header)}
+    month_i, year_i = column['month'], column['year']
+    clientid_i, mal_code_i, uri_i, count_i = column['clientid'], column['mal_code'], column['uri'], column['count']
+    for record in csvreader:
+        if not record:
+            # csv.reader yields [] for a blank line, e.g. a trailing one
+            continue
+        month, year = record[month_i], record[year_i]
+        clientid, uri = record[clientid_i], record[uri_i]
+        # business_function and client_name start as the uri/clientid until mapped
+        yield (month, year, clientid, record[mal_code_i], uri, int(record[count_i]), uri, clientid,
+               f"{year}-{month.zfill(2)}", int(year) * 100 + int(month))
+
+def frame_to_rows(df):
+    """Vectorized transforms from an uploaded DataFrame to transactions rows"""
+    month = pd.to_numeric(df['month']).astype(int)
+    year = pd.to_numeric(df['year']).astype(int)
+    rows = pd.DataFrame({
+        'month': month,
+        'year': year,
+        'clientid': df['clientid'],
+        'mal_code': df['mal_code'],
+        'uri': df['uri'],
+        'count': pd.to_numeric(df['count']).astype(int),
+        # business_function and client_name start as the uri/clientid until mapped
+        'business_function': df['uri'],
+        'client_name': df['clientid'],
+        'date': year.astype(str) + '-' + month.astype(str).str.zfill(2),
+        'month_key': year * 100 + month,
+    })
+    # Blank cells come in as NaN; store them as NULL like the CSV loader's empty values
+    rows = rows.astype(object).where(rows.notna(), None)
+    return rows.itertuples(index=False, name=None)
+
+def insert_dataframe(df):
+    """Insert an uploaded DataFrame with one batched insert in a single transaction"""
+    conn = get_connection('transactions.db')
+    with write_transaction(conn, analytics_store) as staged:
+        STAR_SCHEMA.insert_rows(conn.cursor(), frame_to_rows(df), staged)
+
+# Function to load data from CSV and insert into SQLite
+def load_data_from_csv(csv_file, chunk_size=LOAD_CHUNK_SIZE):
+    """Incrementally load a CSV export into transactions; see usagedb.load_csv"""
+    return load_csv(get_connection('transactions.db'), csv_file, parse_csv_rows, STAR_SCHEMA, analytics_store,
+                    chunk_size)
+
+
+def fetch_filter_options():
+    if analytics_store:
+        return analytics_store.distinct('client_name'), analytics_store.distinct('business_function')
+    conn = get_connection('transactions.db')
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT client_name FROM monthly_rollup")
+    client_names = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT DISTINCT business_function FROM monthly_rollup")
+    business_functions = [row[0] for row in cur.fetchall()]
+    return client_names, business_functions
 
 # Define a route to display the HTML page
 @app.route('/')
 def index():
-    conn = sqlite3.connect('transactions.db')
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT client_name FROM transactions")
-    client_names = [row[0] for row in cur.fetchall()]
-    print(client_names)
-    cur.execute("SELECT DISTINCT business_function FROM transactions")
-    business_functions = [row[0] for row in cur.fetchall()]
-    conn.close()
+    client_names, business_functions = query_cache.get_or_compute(('index',), fetch_filter_options)
     months = [("1", "Jan"), ("2", "Feb"), ("3", "Mar"), ("4", "Apr"), ("5", "May"), ("6", "Jun"), ("7", "Jul"), ("8", "Aug"), ("9", "Sep"), ("10", "Oct"), ("11", "Nov"), ("12", "Dec")]
     years = ["2023", "2024", "2025", "2026"]
     return render_template('index.html', client_names=client_names, business_functions=business_functions,months=months, years=years)
@@ -84,28 +166,48 @@ def get_data():
     start_year = request.form['start_year']
     end_month = request.form['end_month']
     end_year = request.form['end_year']
-    selected_client_names = request.form.getlist('client_name')
-    selected_business_functions = request.form.getlist('business_function')
-
-    conn = sqlite3.connect('transactions.db')
-
+    # Normalize the filters so equivalent requests share one cache entry
+    selected_client_names = sorted(set(request.form.getlist('client_name')))
+    selected_business_functions = sorted(set(request.form.getlist('business_function')))
+    start_key = int(start_year) * 100 + int(start_month)
+    end_key = int(end_year) * 100 + int(end_month)
+    # Optional cut-offs: top_n series by volume plus "Other", and at most max_points per series
+    top_n = int(request.form.get('top_n') or 0) or None
+    max_points = int(request.form.get('max_points') or 0) or None
+
+    key = ('get_data', start_key, end_key, tuple(selected_client_names), tuple(selected_business_functions),
+           top_n, max_points)
+    return query_cache.get_or_compute(
+        key, lambda: fetch_line_data(start_key, end_key, selected_client_names, selected_business_functions,
+                                     top_n, max_points))
+
+def fetch_line_data(start_key, end_key, selected_client_names, selected_business_functions,
+                    top_n=None, max_points=None):
+    if analytics_store:
+        rows = analytics_store.monthly_totals(start_key, end_key, selected_client_names, selected_business_functions)
+        data = pd.DataFrame(rows, columns=['date', 'client_name', 'business_function', 'total_count'])
+        return format_line_data(data[['date', 'total_count', 'client_name', 'business_function']], top_n, max_points)
+
+    conn = get_connection('transactions.db')
+
+    # Totals come pre-aggregated from monthly_rollup, whose key matches this filter
     query = """
-    SELECT date, SUM(count) as total_count, client_name, business_function
-    FROM transactions
+    SELECT printf('%04d-%02d', month_key / 100, month_key % 100) as date, total_count,
+           client_name, business_function
+    FROM monthly_rollup
     WHERE client_name IN ({})
     AND business_function IN ({})
-    AND date BETWEEN ? AND ?
-    GROUP BY date, client_name, business_function
-    ORDER BY date
+    AND month_key BETWEEN ? AND ?
+    ORDER BY month_key
     """.format(','.join(['?'] * len(selected_client_names)), ','.join(['?'] * len(selected_business_functions)))
 
-    start_date = f"{start_year}-{start_month.zfill(2)}"
-    end_date = f"{end_year}-{end_month.zfill(2)}"
-
-    params = selected_client_names + selected_business_functions + [start_date, end_date]
+    params = selected_client_names + selected_business_functions + [start_key, end_key]
 
     data = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    return format_line_data(data, top_n, max_points)
+
+def format_line_data(data, top_n=None, max_points=None):
+    data = reduce_series(data, 'date', ['client_name', 'business_function'], 'total_count', top_n, max_points)
 
     # Convert the date string 'YYYY-MM' to a more readable text format
     data['date'] = pd.to_datetime(data['date']).dt.strftime('%b %Y')
@@ -128,50 +230,23 @@ def upload_csv():
             return "Invalid file format. Please upload a CSV file."
 
         # Read the uploaded CSV file into a Pandas DataFrame
-        df = pd.read_csv(file)
+        df = pd.read_csv(file, dtype=str)
         print(df)
         
         # Check for specific columns in the DataFrame
         if 'clientid' in df.columns and 'client_name' in df.columns:
             print('if bloc 1')
             # Update client names based on clientid
-            for index, row in df.iterrows():
-                client_id = row['clientid']
-                new_client_name = row['client_name']
-                update_client_name(client_id, new_client_name)
+            update_client_names(df[['clientid', 'client_name']].itertuples(index=False, name=None))
 
         elif 'uri' in df.columns and 'business_function' in df.columns:
             # Update business functions based on uri
             print('if bloc 2')
-            for index, row in df.iterrows():
-                uri = row['uri']
-                new_business_function = row['business_function']
-                update_business_function(uri, new_business_function)
+            update_business_functions(df[['uri', 'business_function']].itertuples(index=False, name=None))
 
         elif 'month' in df.columns and 'year' in df.columns:
             print('if bloc 3')
-            for index, row in df.iterrows():
-                # Implement logic to insert new data based on your requirements
-                month = row['month']
-                year = row['year']
-                clientid = row['clientid']
-                mal_code = row['mal_code']
-                uri = row['uri']
-                count = int(row['count'])
-                business_function = row['uri']   # Replace with actual data
-                client_name =  row['clientid']# Replace with actual data
-                date = f"{year}-{month.zfill(2)}"  # Combine year and month
-                print(date)
-                conn = sqlite3.connect('transactions.db')
-                cursor = conn.cursor()
-                # Insert data into the SQLite database 
-                cursor.execute('''
-                    INSERT INTO transactions (month, year, clientid, mal_code, uri, count, business_function, client_name, date)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (month, year, clientid, mal_code, uri, count, business_function, client_name, date))
-                conn.commit()
-                conn.close()
-                pass
+            insert_dataframe(df)
         
 
         return "CSV file processed successfully."
@@ -179,54 +254,81 @@ def upload_csv():
     except Exception as e:
         return "Error: " + str(e)
 
-def update_client_name(client_id, new_client_name):
-    # Implement logic to update client names in your database
-    conn = sqlite3.connect('transactions.db')
-    cursor = conn.cursor()
-    # Insert data into the SQLite database 
-    cursor.execute('''
-        UPDATE  transactions client_name = ? WHERE client_id = ?
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (new_client_name,client_id))
-    conn.commit()
-    conn.close()
-    pass
+def apply_mapping(table, key_column, value_column, pairs):
+    """Apply (key, value) pairs to a dimension; see usagedb.remap_dimension"""
+    conn = get_connection('transactions.db')
+    with write_transaction(conn, analytics_store) as staged:
+        return remap_dimension(conn.cursor(), STAR_SCHEMA, table, key_column, value_column, pairs, staged)
 
-def update_business_function(uri, new_business_function):
-    # Implement logic to update business functions in your database
-    pass
+def update_client_names(pairs):
+    # Map clientid -> client_name for every transaction of those clients
+    return apply_mapping('clients', 'clientid', 'client_name', pairs)
+
+def update_business_functions(pairs):
+    # Map uri -> business_function for every transaction on those uris
+    return apply_mapping('uris', 'uri', 'business_function', pairs)
 
 
 @app.route('/get_transactions', methods=['POST'])
 def get_transactions():
-   
-
-    conn = sqlite3.connect('transactions.db')
-    cursor = conn.cursor()
-
-    query = """
-    SELECT date, client_name, business_function, count
-    FROM transactions    
     """
-    
- 
-
-    cursor.execute(query)
-    data = cursor.fetchall()
-
-    conn.close()
-
-    result = []
-    for row in data:
-        result.append({
-            'date': row[0],
-            'client_name': row[1],
-            'business_function': row[2],
-            'count': row[3]
-            # Add other columns as needed
-        })
+    Stream transactions as the same {"data": [...]} document, written in
+    chunks while walking the table by rowid. Optional start_date/end_date
+    ('YYYY-MM') and client_name filters may be sent as form or query values.
+    """
+    conditions = []
+    params = []
+    start_date = request.values.get('start_date')
+    end_date = request.values.get('end_date')
+    client_names = request.values.getlist('client_name')
+    # The unary + keeps the month and client indexes out of the plan, so each
+    # page is a scan along the rowid range rather than an index lookup that
+    # then has to sort its matches by rowid
+    if start_date:
+        conditions.append('+f.month_key >= ?')
+        params.append(int(start_date[:4] + start_date[5:7]))
+    if end_date:
+        conditions.append('+f.month_key <= ?')
+        params.append(int(end_date[:4] + end_date[5:7]))
+    if client_names:
+        conditions.append('+f.client_key IN (SELECT id FROM clients WHERE client_name IN ({}))'.format(
+            ','.join(['?'] * len(client_names))))
+        params.extend(client_names)
 
-    return jsonify({'data': result})
+    query = """
+    SELECT f.rowid, {}, c.client_name, u.business_function, f.count
+    FROM transaction_facts f
+    JOIN clients c ON c.id = f.client_key
+    JOIN uris u ON u.id = f.uri_key
+    WHERE f.rowid > ? {}
+    ORDER BY f.rowid
+    LIMIT ?
+    """.format(STAR_SCHEMA.view_column('date'), ''.join(' AND ' + condition for condition in conditions))
+
+    def generate():
+        conn = get_connection('transactions.db')
+        yield '{"data": ['
+        last_rowid = 0
+        separator = ''
+        while True:
+            rows = conn.execute(query, [last_rowid] + params + [EXPORT_BATCH_SIZE]).fetchall()
+            if not rows:
+                break
+            # Keyset cursor: resume after the last rowid instead of an OFFSET
+            last_rowid = rows[-1][0]
+            chunk = []
+            for rowid, date, client_name, business_function, count in rows:
+                chunk.append(separator + json.dumps({
+                    'date': date,
+                    'client_name': client_name,
+                    'business_function': business_function,
+                    'count': count
+                }))
+                separator = ','
+            yield ''.join(chunk)
+        yield ']}'
+
+    return Response(generate(), mimetype='application/json')
 
 if __name__ == '__main__':
     create_database()
@@ -4,20 +4,83 @@ import dash_html_components as html
 from dash.dependencies import Input, Output
 import plotly.express as px
 import sqlite3
+from dbpool import get_connection
+from analytics import open_store
+from usagedb import StarSchema, setup_database, load_csv, LOAD_CHUNK_SIZE
 import pandas as pd
-import csv
 import dash_table
-from dash.dependencies import Input, Output, State
 
 app = dash.Dash(__name__)
-# Initialize data variable outside of the callback
-data = None
+
+# Columns shown in the Tab 3 table
+TABLE_COLUMNS = ['month', 'year', 'clientid', 'mal_code', 'uri', 'count', 'business_function', 'client_name']
+TABLE_PAGE_SIZE = 10
+# Where each Tab 3 column lives, so a sorted page is ranked on the facts joined to
+# that one dimension instead of through the whole transactions view
+SORT_SOURCES = {
+    'month': ('f.month', ''),
+    'year': ('f.year', ''),
+    'count': ('f.count', ''),
+    'clientid': ('c.clientid', 'JOIN clients c ON c.id = f.client_key'),
+    'client_name': ('c.client_name', 'JOIN clients c ON c.id = f.client_key'),
+    'uri': ('u.uri', 'JOIN uris u ON u.id = f.uri_key'),
+    'business_function': ('u.business_function', 'JOIN uris u ON u.id = f.uri_key'),
+    'mal_code': ('m.mal_code', 'JOIN mal_codes m ON m.id = f.mal_code_key'),
+}
+# Set by create_database when SQLite has FTS5; otherwise Tab 3 search falls back to LIKE
+fts_enabled = False
+
+# Row layout of the CSV loader and ingest.py, stored as transaction_facts behind the transactions view
+STAR_SCHEMA = StarSchema(
+    'transactions', 'transaction_facts',
+    ['month', 'year', 'clientid', 'mal_code', 'uri', 'count', 'business_function', 'client_name', 'month_key'],
+    {'month': 'INTEGER', 'year': 'INTEGER', 'count': 'INTEGER', 'month_key': 'INTEGER'},
+)
+
+# Versioned schema changes applied at startup; entry N moves user_version to N
+SCHEMA_MIGRATIONS = [
+    # 1: integer YYYYMM month key so monthly grouping sorts as a number
+    [
+        'ALTER TABLE transactions ADD COLUMN month_key INTEGER',
+        'UPDATE transactions SET month_key = CAST(year AS INTEGER) * 100 + CAST(month AS INTEGER)',
+    ],
+    # 2: covering index for the line graph filter and the DISTINCT dropdown lists
+    [
+        'CREATE INDEX IF NOT EXISTS idx_transactions_client_function_month '
+        'ON transactions (client_name, business_function, month_key, count)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_function ON transactions (business_function)',
+    ],
+    # 3: monthly rollup the line graph and dropdowns read instead of the raw rows
+    [
+        '''CREATE TABLE IF NOT EXISTS monthly_rollup (
+            month_key INTEGER,
+            client_name TEXT,
+            business_function TEXT,
+            total_count INTEGER,
+            PRIMARY KEY (client_name, business_function, month_key)
+        ) WITHOUT ROWID''',
+        '''INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+        SELECT month_key, IFNULL(client_name, ''), IFNULL(business_function, ''), SUM(count)
+        FROM transactions
+        WHERE month_key IS NOT NULL
+        GROUP BY 1, 2, 3''',
+    ],
+    # 4: fingerprints of the CSV exports already loaded, for incremental startup
+    [
+        '''CREATE TABLE IF NOT EXISTS source_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            head_hash TEXT,
+            rows INTEGER
+        )''',
+    ],
+    *STAR_SCHEMA.migrations(),
+]
 
 def create_database():
-    conn = sqlite3.connect('apidata.db')
+    conn = get_connection('apidata.db')
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE transactions')
-    conn.commit()
     # Create the table with the necessary columns
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
@@ -32,7 +95,60 @@ def create_database():
         )
     ''')
     conn.commit()
-    conn.close()
+    setup_database(conn, SCHEMA_MIGRATIONS, 'transactions', analytics_store)
+    global fts_enabled
+    fts_enabled = create_search_index(conn)
+
+def create_search_index(conn):
+    """
+    Create the FTS5 index behind the Tab 3 search over the transactions view,
+    kept in sync by triggers on transaction_facts that look the names up in
+    the dimensions. Returns False when SQLite was built without FTS5.
+    """
+    has_index = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'transactions_fts'").fetchone()
+    # Triggers go away with the table they are on, as when the star schema migration replaced transactions
+    if has_index and conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'transactions_fts_insert'").fetchone():
+        return True
+    try:
+        conn.execute('BEGIN')
+        with conn:
+            if not has_index:
+                conn.execute('''
+                    CREATE VIRTUAL TABLE transactions_fts USING fts5(
+                        client_name, business_function, month, year,
+                        content='transactions', content_rowid='rowid'
+                    )
+                ''')
+            conn.execute('''
+                CREATE TRIGGER transactions_fts_insert AFTER INSERT ON transaction_facts BEGIN
+                    INSERT INTO transactions_fts (rowid, client_name, business_function, month, year)
+                    SELECT new.rowid, c.client_name, u.business_function, new.month, new.year
+                    FROM clients c, uris u WHERE c.id = new.client_key AND u.id = new.uri_key;
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER transactions_fts_delete AFTER DELETE ON transaction_facts BEGIN
+                    INSERT INTO transactions_fts (transactions_fts, rowid, client_name, business_function, month, year)
+                    SELECT 'delete', old.rowid, c.client_name, u.business_function, old.month, old.year
+                    FROM clients c, uris u WHERE c.id = old.client_key AND u.id = old.uri_key;
+                END
+            ''')
+            conn.execute('''
+                CREATE TRIGGER transactions_fts_update AFTER UPDATE ON transaction_facts BEGIN
+                    INSERT INTO transactions_fts (transactions_fts, rowid, client_name, business_function, month, year)
+                    SELECT 'delete', old.rowid, c.client_name, u.business_function, old.month, old.year
+                    FROM clients c, uris u WHERE c.id = old.client_key AND u.id = old.uri_key;
+                    INSERT INTO transactions_fts (rowid, client_name, business_function, month, year)
+                    SELECT new.rowid, c.client_name, u.business_function, new.month, new.year
+                    FROM clients c, uris u WHERE c.id = new.client_key AND u.id = new.uri_key;
+                END
+            ''')
+            if not has_index:
+                # Index the rows that were loaded before the search index existed
+                conn.execute("INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        return False
+    return True
 
 # Define the layout with tabs
 app.layout = html.Div([
@@ -44,29 +160,29 @@ app.layout = html.Div([
     html.Div(id='tab-content')
 ])
 
-# Function to load data from CSV and insert into SQLite
-def load_data_from_csv(csv_file):
-    with open(csv_file, 'r') as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for row in csvreader:
-            month = row['month']
-            year = row['year']
-            clientid = row['clientid']
-            mal_code = row['mal_code']
-            uri = row['uri']
-            count = int(row['count'])
-            business_function = row['uri']   # Replace with actual data
-            client_name =  row['clientid']# Replace with actual data
-            
-            # Insert data into the SQLite database
-            conn = sqlite3.connect('apidata.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO transactions (month, year, clientid, mal_code, uri, count, business_function, client_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (month, year, clientid, mal_code, uri, count, business_function, client_name))
-            conn.commit()
-            conn.close()
+# Parquet/DuckDB mirror used for the dashboard aggregations when ANALYTICS_BACKEND=duckdb
+analytics_store = open_store('apidata')
+
+def parse_csv_rows(csvreader):
+    """Yield transactions rows from a csv.reader positioned at the header line"""
+    header = next(csvreader)
+    column = {name: i for i, name in enumerate(header)}
+    month_i, year_i = column['month'], column['year']
+    clientid_i, mal_code_i, uri_i, count_i = column['clientid'], column['mal_code'], column['uri'], column['count']
+    for record in csvreader:
+        if not record:
+            # csv.reader yields [] for a blank line, e.g. a trailing one
+            continue
+        month, year = record[month_i], record[year_i]
+        clientid, uri = record[clientid_i], record[uri_i]
+        # business_function and client_name start as the uri/clientid until mapped
+        yield (month, year, clientid, record[mal_code_i], uri, int(record[count_i]), uri, clientid,
+               int(year) * 100 + int(month))
+
+def load_data_from_csv(csv_file, chunk_size=LOAD_CHUNK_SIZE):
+    """Incrementally load a CSV export into transactions; see usagedb.load_csv"""
+    return load_csv(get_connection('apidata.db'), csv_file, parse_csv_rows, STAR_SCHEMA, analytics_store,
+                    chunk_size)
 
 # Sample CSS style for basic formatting
 app.css.append_css({
@@ -90,7 +206,6 @@ app.css.append_css({
 
 @app.callback(Output('tab-content', 'children'), [Input('tabs', 'value')])
 def render_content(tab):
-    global data  # Access the global data variable
     if tab == 'tab1':
         return html.Div([
             dcc.Dropdown(id='client-dropdown', options=[{'label': name, 'value': name} for name in get_client_names()]),
@@ -99,22 +214,19 @@ def render_content(tab):
         ])
     elif tab == 'tab2':
         return html.Div('Tab 2 Content')
-    #global data  # Access the global data variable
     elif tab == 'tab3':
-        if data is None:
-            # Query the SQLite database to fetch all transactions
-            conn = sqlite3.connect('apidata.db')
-            query = "SELECT * FROM transactions"
-            data = pd.read_sql(query, conn)
-
+        # Rows are fetched a page at a time by update_table
         return html.Div([
             dcc.Input(id='search-input', type='text', placeholder='Search Client, Function, Month, Year'),
             dash_table.DataTable(
                 id='table',
-                columns=[{'name': col, 'id': col} for col in data.columns],
-                data=data.to_dict('records'),
+                columns=[{'name': col, 'id': col} for col in TABLE_COLUMNS],
                 page_current=0,
-                page_size=10,
+                page_size=TABLE_PAGE_SIZE,
+                page_action='custom',
+                sort_action='custom',
+                sort_mode='single',
+                sort_by=[],
             )
         ])
     else:
@@ -122,68 +234,101 @@ def render_content(tab):
 
     
 def get_client_names():
-    conn = sqlite3.connect('apidata.db')
-    query = "SELECT DISTINCT client_name FROM transactions"
+    if analytics_store:
+        return analytics_store.distinct('client_name')
+    conn = get_connection('apidata.db')
+    query = "SELECT DISTINCT client_name FROM monthly_rollup"
     data = pd.read_sql(query, conn)
     return data['client_name'].tolist()
 
 def get_business_functions():
-    conn = sqlite3.connect('apidata.db')
-    query = "SELECT DISTINCT business_function FROM transactions"
+    if analytics_store:
+        return analytics_store.distinct('business_function')
+    conn = get_connection('apidata.db')
+    query = "SELECT DISTINCT business_function FROM monthly_rollup"
     data = pd.read_sql(query, conn)
     return data['business_function'].tolist()
 
 @app.callback(Output('line-graph', 'figure'), [Input('client-dropdown', 'value'), Input('function-dropdown', 'value')])
 def update_line_graph(selected_client, selected_function):
-    conn = sqlite3.connect('apidata.db')
-    query = f"SELECT month, year, SUM(count) as total_count FROM transactions WHERE client_name = '{selected_client}' AND business_function = '{selected_function}' GROUP BY month, year"
-    data = pd.read_sql(query, conn)
+    if analytics_store:
+        rows = analytics_store.monthly_totals(0, 999912, [selected_client], [selected_function])
+        data = pd.DataFrame([(int(month[5:]), int(month[:4]), total) for month, _, _, total in rows],
+                            columns=['month', 'year', 'total_count'])
+    else:
+        conn = get_connection('apidata.db')
+        query = """
+            SELECT month_key % 100 AS month, month_key / 100 AS year, total_count
+            FROM monthly_rollup
+            WHERE client_name = ? AND business_function = ?
+            ORDER BY month_key
+        """
+        data = pd.read_sql(query, conn, params=(selected_client, selected_function))
     
     fig = px.line(data, x='month', y='total_count', title=f'Total Count of Transactions for {selected_client} - {selected_function}', markers=True)
     return fig
 
 
 
-# Add a callback to update the table based on search input and pagination for Tab 3
-# Add a callback to update the table based on search input and pagination for Tab 3
+def search_condition(search_value):
+    """WHERE clause and parameters matching rows that contain any of the search terms"""
+    search_terms = (search_value or '').split()
+    if not search_terms:
+        return '', []
+    if fts_enabled:
+        # Prefix match each term as a quoted FTS5 string, any term may match
+        match = ' OR '.join('"{}"*'.format(term.replace('"', '""')) for term in search_terms)
+        return 'WHERE rowid IN (SELECT rowid FROM transactions_fts WHERE transactions_fts MATCH ?)', [match]
+    conditions = []
+    values = []
+    for term in search_terms:
+        conditions.append("(client_name LIKE ? OR business_function LIKE ? OR month LIKE ? OR year LIKE ?)")
+        values.extend(['%' + term + '%' for _ in range(4)])
+    return 'WHERE ' + ' OR '.join(conditions), values
+
+# Serve the Tab 3 table one page at a time: search, sort and paging all run in SQL
 @app.callback(
     Output('table', 'data'),
+    Output('table', 'page_count'),
     Output('table', 'page_current'),
     [Input('search-input', 'value')],
     [Input('table', 'page_current')],
-    [State('table', 'data')],
-    [State('tabs', 'value')]
+    [Input('table', 'page_size')],
+    [Input('table', 'sort_by')]
 )
-def update_table(search_value, page_current, current_data, tab_value):
-    if tab_value == 'tab3':
-        if search_value is None:
-            search_value = ''
-
-        # Split the search value into individual search terms
-        search_terms = search_value.split()
-
-        # Create a list to store parameterized conditions for filtering
-        conditions = []
+def update_table(search_value, page_current, page_size, sort_by):
+    # A new search starts again from the first page
+    if any(t['prop_id'] == 'search-input.value' for t in dash.callback_context.triggered):
+        page_current = 0
+    page_current = page_current or 0
+    where, values = search_condition(search_value)
 
-        # Create a list to store the values to be used in the parameterized query
-        values = []
-
-        if search_terms:
-            for term in search_terms:
-                conditions.append("(client_name LIKE ? OR business_function LIKE ? OR month LIKE ? OR year LIKE ?)")
-                values.extend(['%' + term + '%' for _ in range(4)])
-
-            # Join the conditions with 'OR' to filter based on any of the search terms
-            sql_condition = ' OR '.join(conditions)
+    if sort_by and sort_by[0]['column_id'] in SORT_SOURCES:
+        column = sort_by[0]['column_id']
+        expression, join = SORT_SOURCES[column]
+        direction = 'DESC' if sort_by[0]['direction'] == 'desc' else 'ASC'
+        search = f'WHERE f.rowid IN (SELECT rowid FROM transactions {where})' if where else ''
+        # Only the page's rows are read back through the view
+        query = f'''
+            SELECT {', '.join(TABLE_COLUMNS)} FROM transactions
+            WHERE rowid IN (
+                SELECT f.rowid FROM transaction_facts f {join} {search}
+                ORDER BY {expression} {direction}, f.rowid LIMIT ? OFFSET ?
+            )
+            ORDER BY {column} {direction}, rowid
+        '''
+    else:
+        query = f"SELECT {', '.join(TABLE_COLUMNS)} FROM transactions {where} ORDER BY rowid LIMIT ? OFFSET ?"
 
-            # Filter the data based on the parameterized query
-            filtered_data = data.query(sql_condition, values=values)
-        else:
-            filtered_data = data  # No search terms, so no filtering
+    conn = get_connection('apidata.db')
+    # Every fact appears once in the view, so count the fact table itself unless the
+    # LIKE fallback needs the joined names; an FTS match is a rowid filter on the facts
+    count_table = 'transactions' if where and not fts_enabled else 'transaction_facts'
+    total = conn.execute(f"SELECT COUNT(*) FROM {count_table} {where}", values).fetchone()[0]
+    page = pd.read_sql(query, conn, params=values + [page_size, page_current * page_size])
 
-        return filtered_data.iloc[page_current * 10:(page_current + 1) * 10].to_dict('records'), page_current
-    else:
-        return dash.no_update
+    page_count = max(1, -(-total // page_size))
+    return page.to_dict('records'), page_count, page_current
 
 if __name__ == '__main__':
     create_database()
@@ -1,10 +1,10 @@
-import sqlite3
+from dbpool import get_connection
 from flask import Flask, render_template, request, redirect, url_for
 
 app = Flask(__name__)
 
 # Create a SQLite database and connect to it
-conn = sqlite3.connect('data.db')
+conn = get_connection('data.db')
 cursor = conn.cursor()
 
 # Create a table to store the data if it doesn't exist
@@ -27,7 +27,6 @@ cursor.execute('''
     )
 ''')
 conn.commit()
-conn.close()
 
 @app.route('/')
 def index():
@@ -35,7 +34,7 @@ def index():
     data = []
 
     # Fetch data from the database and convert each row into a dictionary
-    conn = sqlite3.connect('data.db')
+    conn = get_connection('data.db')
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM data')
     
@@ -48,7 +47,6 @@ def index():
             data_dict[column] = row[i]  # Assign each column value to the corresponding key
         data.append(data_dict)  # Append the dictionary to the list
 
-    conn.close()
     # Calculate average code coverage per resource name
     avg_code_coverage_data = {}
     print('--------------',data)
@@ -94,19 +92,18 @@ def add():
         code_review_comments = int(request.form['code_review_comments'])
     
         # Insert data into the database
-        conn = sqlite3.connect('data.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO data (project, role, resource_name, api_name, api_endpoint, planned_sit_date,
-                              actual_sit_date, planned_pat_date, actual_pat_date, defects, code_coverage,
-                              promotion_failures, code_review_comments)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (project, role, resource_name, api_name, api_endpoint, planned_sit_date, actual_sit_date,
-              planned_pat_date, actual_pat_date, defects, code_coverage, promotion_failures,
-              code_review_comments))
+        conn = get_connection('data.db')
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO data (project, role, resource_name, api_name, api_endpoint, planned_sit_date,
+                                  actual_sit_date, planned_pat_date, actual_pat_date, defects, code_coverage,
+                                  promotion_failures, code_review_comments)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (project, role, resource_name, api_name, api_endpoint, planned_sit_date, actual_sit_date,
+                  planned_pat_date, actual_pat_date, defects, code_coverage, promotion_failures,
+                  code_review_comments))
         print('hello...2')
-        conn.commit()
-        conn.close()
 
     return redirect(url_for('index'))
 
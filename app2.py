@@ -1,20 +1,70 @@
-import sqlite3
+from dbpool import get_connection
+from analytics import open_store
+from usagedb import QueryCache, StarSchema, setup_database, write_transaction, remap_dimension, load_csv, LOAD_CHUNK_SIZE
 import dash
-import csv
 from dash import dcc, html, Input, Output, State
 import plotly.graph_objs as go
 import pandas as pd
 import io
 import base64
+from chartseries import reduce_series
 
 app = dash.Dash(__name__, external_stylesheets=['https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css'])
 
+# data rows as parse_csv_rows and frame_to_rows yield them, stored as data_facts behind the data view
+STAR_SCHEMA = StarSchema(
+    'data', 'data_facts',
+    ['date', 'clientid', 'mal_code', 'uri', 'count', 'business_function', 'client_name', 'month_key'],
+    {'date': 'TEXT', 'count': 'INTEGER', 'month_key': 'INTEGER'},
+)
+
+# Versioned schema changes applied at startup; entry N moves user_version to N
+SCHEMA_MIGRATIONS = [
+    # 1: integer YYYYMM month key so monthly grouping doesn't call strftime per row
+    [
+        'ALTER TABLE data ADD COLUMN month_key INTEGER',
+        "UPDATE data SET month_key = CAST(strftime('%Y%m', date) AS INTEGER)",
+    ],
+    # 2: covering index for the date-range dashboard query, plus the mapping update key
+    [
+        'CREATE INDEX IF NOT EXISTS idx_data_date_month_client_function '
+        'ON data (date, month_key, client_name, business_function, count)',
+        'CREATE INDEX IF NOT EXISTS idx_data_clientid ON data (clientid)',
+    ],
+    # 3: monthly rollup the dashboard reads instead of the raw rows
+    [
+        '''CREATE TABLE IF NOT EXISTS monthly_rollup (
+            month_key INTEGER,
+            client_name TEXT,
+            business_function TEXT,
+            total_count INTEGER,
+            PRIMARY KEY (month_key, client_name, business_function)
+        ) WITHOUT ROWID''',
+        '''INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+        SELECT month_key, IFNULL(client_name, ''), IFNULL(business_function, ''), SUM(count)
+        FROM data
+        WHERE month_key IS NOT NULL
+        GROUP BY 1, 2, 3''',
+    ],
+    # 4: fingerprints of the CSV exports already loaded, for incremental startup
+    [
+        '''CREATE TABLE IF NOT EXISTS source_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            head_hash TEXT,
+            rows INTEGER
+        )''',
+    ],
+    *STAR_SCHEMA.migrations(),
+]
+
+query_cache = QueryCache('data.db')
+
 # Function to create an SQLite database and table (if not exists)
 def create_database():
-    conn = sqlite3.connect('data.db')
+    conn = get_connection('data.db')
     cursor = conn.cursor()
-    cursor.execute('DROP TABLE data')
-    conn.commit()
     # Create the table with the necessary columns
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS data (
@@ -28,30 +78,48 @@ def create_database():
         )
     ''')
     conn.commit()
-    conn.close()
+    setup_database(conn, SCHEMA_MIGRATIONS, 'data', analytics_store)
+
+# Parquet/DuckDB mirror used for the dashboard aggregations when ANALYTICS_BACKEND=duckdb
+analytics_store = open_store('data')
+
+def parse_csv_rows(csvreader):
+    """Yield data rows from a csv.reader positioned at the header line"""
+    header = next(csvreader)
+    column = {name: i for i, name in enumerate(header)}
+    date_i, clientid_i, mal_code_i = column['date'], column['clientid'], column['mal_code']
+    uri_i, count_i = column['uri'], column['count']
+    for record in csvreader:
+        if not record:
+            # csv.reader yields [] for a blank line, e.g. a trailing one
+            continue
+        date, clientid, uri = record[date_i], record[clientid_i], record[uri_i]
+        # business_function and client_name start as the uri/clientid until mapped
+        yield (date, clientid, record[mal_code_i], uri, int(record[count_i]), uri, clientid,
+               int(date[:4] + date[5:7]))
+
+def frame_to_rows(df):
+    """Vectorized transforms from an uploaded DataFrame to data rows"""
+    rows = pd.DataFrame({
+        'date': df['date'],
+        'clientid': df['clientid'],
+        'mal_code': df['mal_code'],
+        'uri': df['uri'],
+        'count': pd.to_numeric(df['count']).astype(int),
+        # business_function and client_name start as the uri/clientid until mapped
+        'business_function': df['uri'],
+        'client_name': df['clientid'],
+        'month_key': (df['date'].str[:4] + df['date'].str[5:7]).astype(int),
+    })
+    # Blank cells come in as NaN; store them as NULL
+    rows = rows.astype(object).where(rows.notna(), None)
+    return rows.itertuples(index=False, name=None)
 
 # Function to load data from CSV and insert into SQLite
-def load_data_from_csv(csv_file):
-    with open(csv_file, 'r') as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for row in csvreader:
-            date = row['date']
-            clientid = row['clientid']
-            mal_code = row['mal_code']
-            uri = row['uri']
-            count = int(row['count'])
-            business_function = row['uri']   # Replace with actual data
-            client_name =  row['clientid']# Replace with actual data
-            
-            # Insert data into the SQLite database
-            conn = sqlite3.connect('data.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO data (date, clientid, mal_code, uri, count, business_function, client_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (date, clientid, mal_code, uri, count, business_function, client_name))
-            conn.commit()
-            conn.close()
+def load_data_from_csv(csv_file, chunk_size=LOAD_CHUNK_SIZE):
+    """Incrementally load a CSV export into data; see usagedb.load_csv"""
+    return load_csv(get_connection('data.db'), csv_file, parse_csv_rows, STAR_SCHEMA, analytics_store,
+                    chunk_size)
 
 
 app.layout = html.Div([
@@ -88,6 +156,10 @@ app.layout = html.Div([
             dcc.DatePickerSingle(id='end-date-picker', date='2023-12-31'),
             html.Label(' ', className='mr-2'),
 
+            # Optional cut-offs, left empty to draw every series at every point
+            dcc.Input(id='top-n-input', type='number', min=1, placeholder='Top N series', className='mr-2'),
+            dcc.Input(id='max-points-input', type='number', min=3, placeholder='Max points per series', className='mr-2'),
+
             html.Button('Generate Graphs', id='generate-button', className='btn btn-primary mr-2'),
 
            
@@ -138,41 +210,22 @@ def update_database_with_csv(contents, filename):
 
     content_type, content_string = contents.split(',')
     decoded = base64.b64decode(content_string)
-    print('decoded',decoded)
-    df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
+    df = pd.read_csv(io.BytesIO(decoded), dtype=str)
     print('df',df)
-    conn = sqlite3.connect('data.db')
+    conn = get_connection('data.db')
     cursor = conn.cursor()
 
-    if 'clientid' in df.columns and 'client_name' in df.columns:
-        # Check if the file contains 'clientid' and 'client_name' columns
-        for index, row in df.iterrows():
-            clientid = row['clientid']
-            client_name = row['client_name']
-            cursor.execute('''
-                UPDATE data
-                SET client_name = ?
-                WHERE clientid = ?
-            ''', (client_name, clientid))
-    else:
-        # If not, update all fields for the entire data table
-        #cursor.execute('DELETE FROM data')  # Clear existing data
-        for index, row in df.iterrows():
-            cursor.execute('''
-                INSERT INTO data (date, clientid, mal_code, uri, count, business_function, client_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                row['date'],
-                row['clientid'],
-                row['mal_code'],
-                row['uri'],
-                row['count'],
-                row['uri'],
-                row['clientid']
-            ))
-
-    conn.commit()
-    conn.close()
+    # Roll back on failure so the reused connection isn't left mid-transaction
+    with write_transaction(conn, analytics_store) as staged:
+        if 'clientid' in df.columns and 'client_name' in df.columns:
+            # Check if the file contains 'clientid' and 'client_name' columns
+            # Apply the mapping with a single UPDATE, regrouping only the totals it touches
+            remap_dimension(cursor, STAR_SCHEMA, 'clients', 'clientid', 'client_name',
+                            df[['clientid', 'client_name']].itertuples(index=False, name=None), staged)
+        else:
+            # If not, update all fields for the entire data table
+            #cursor.execute('DELETE FROM data')  # Clear existing data
+            STAR_SCHEMA.insert_rows(cursor, frame_to_rows(df), staged)
 
     return html.Div(f'Updated {len(df)} records with client names from CSV file: {filename}',style={'text-align': 'center','font-size': '14px','verticalAlign': 'middle'})
 
@@ -183,48 +236,66 @@ def update_database_with_csv(contents, filename):
     Input('tabs', 'value'),
     Input('generate-button', 'n_clicks'),
     Input('start-date-picker', 'date'),
-    Input('end-date-picker', 'date')
+    Input('end-date-picker', 'date'),
+    State('top-n-input', 'value'),
+    State('max-points-input', 'value')
 )
-def render_content(tab, n_clicks, start_date, end_date):
+def render_content(tab, n_clicks, start_date, end_date, top_n, max_points):
     if n_clicks is None:
         return
     
-    # Fetch data from the database based on date range
-    conn = sqlite3.connect('data.db')
-    query = f'''
-        SELECT strftime('%Y-%m', date) AS month, client_name, business_function, SUM(count) as total_count
-        FROM data
-        WHERE date BETWEEN ? AND ?
-        GROUP BY month, client_name, business_function
-    '''
-    data = conn.execute(query, (start_date, end_date)).fetchall()
-    print(data)
+    # Identical tab/month-range/cut-off requests reuse the figure until the data changes
+    start_key = int(start_date[:4] + start_date[5:7])
+    end_key = int(end_date[:4] + end_date[5:7])
+    top_n = int(top_n) if top_n else None
+    max_points = int(max_points) if max_points else None
+    figure = query_cache.get_or_compute((tab, start_key, end_key, top_n, max_points),
+                                        lambda: build_figure(tab, start_key, end_key, top_n, max_points))
+    if figure is not None:
+        return dcc.Graph(figure=figure)
+
+def build_figure(tab, start_key, end_key, top_n=None, max_points=None):
+    # Fetch the monthly totals for every month touched by the date range
+    if analytics_store:
+        rows = analytics_store.monthly_totals(start_key, end_key)
+    else:
+        conn = get_connection('data.db')
+        query = f'''
+            SELECT printf('%04d-%02d', month_key / 100, month_key % 100) AS month, client_name, business_function,
+                   total_count
+            FROM monthly_rollup
+            WHERE month_key BETWEEN ? AND ?
+            ORDER BY month_key
+        '''
+        rows = conn.execute(query, (start_key, end_key)).fetchall()
+    data = pd.DataFrame(rows, columns=['month', 'client_name', 'business_function', 'total_count'])
+    data = reduce_series(data, 'month', ['client_name', 'business_function'], 'total_count', top_n, max_points)
 
     if tab == 'tab-1':
         # Render the updated first graph
-        return dcc.Graph(figure=generate_graph1(data))
+        return generate_graph1(data)
     elif tab == 'tab-2':
         # Render the second graph
-        return dcc.Graph(figure=generate_graph2(data))
+        return generate_graph2(data)
 
 # Function to generate the updated first graph
 def generate_graph1(data):
     df = pd.DataFrame(data, columns=['month', 'client_name', 'business_function', 'total_count'])
-    
-    fig = go.Figure()
-
-    for client_name in df['client_name'].unique():
-        print(client_name)
-        client_data = df[df['client_name'] == client_name]
-        for function_name in client_data['business_function'].unique():
-            function_data = client_data[client_data['business_function'] == function_name]
-            fig.add_trace(go.Scatter(
-                x=client_data['month'],
-                y=function_data['total_count'],
-                mode='lines+markers',
-                name=f'{client_name} - {function_name}'
-            ))
-    
+
+    # One grouped sum gives every (client, function) series; each trace only has
+    # the months its series has rows for, as max_points may have thinned them
+    totals = df.groupby(['client_name', 'business_function', 'month'], dropna=False)['total_count'].sum()
+
+    fig = go.Figure([
+        go.Scatter(
+            x=series.index.get_level_values('month').tolist(),
+            y=series.to_numpy(),
+            mode='lines+markers',
+            name=f'{client_name} - {business_function}'
+        )
+        for (client_name, business_function), series in totals.groupby(level=[0, 1], dropna=False)
+    ])
+
     fig.update_layout(title='Monthly Total Count by Client Name and Business Function', xaxis_title='Month', yaxis_title='Total Count')
     
     return fig
@@ -232,36 +303,27 @@ def generate_graph1(data):
 # Function to generate the second graph
 def generate_graph2(data):
     df = pd.DataFrame(data, columns=['month', 'client_name', 'business_function', 'total_count'])
-    
-    # Create a color scale mapping each unique client name to a different color
-    color_scale = {client_name: 'rgb({}, {}, {})'.format(
-        int(255 * (i / len(df['client_name'].unique()))),
-        int(100 + 155 * (i / len(df['client_name'].unique()))),
-        int(100 + 155 * (i / len(df['client_name'].unique())))
-    ) for i, client_name in enumerate(df['client_name'].unique())}
-    
-    fig = go.Figure()
-    
-    # Use a dictionary to store unique legend names for each client
-    legend_names = {}
-    
-    for month in df['month'].unique():
-        month_data = df[df['month'] == month]
-        for client_name in month_data['client_name'].unique():
-            client_data = month_data[month_data['client_name'] == client_name]
-            total_count = client_data['total_count'].sum()
-            
-            # Create a unique legend name for each client based on just the client name
-            if client_name not in legend_names:
-                legend_names[client_name] = f'{client_name}-{month}'
-            
-            fig.add_trace(go.Bar(
-                x=[month],
-                y=[total_count],
-                name=legend_names[client_name],
-                marker=dict(color=color_scale[client_name])
+
+    # Monthly totals per client in one pass, then one bar trace per client over its own months
+    totals = df.groupby(['client_name', 'month'], dropna=False)['total_count'].sum()
+    clients = list(totals.groupby(level=0, dropna=False))
+    client_count = len(clients)
+
+    # One bar trace per client, each coloured along the same scale as before
+    fig = go.Figure([
+        go.Bar(
+            x=series.index.get_level_values('month').tolist(),
+            y=series.to_numpy(),
+            name=client_name,
+            marker=dict(color='rgb({}, {}, {})'.format(
+                int(255 * (i / client_count)),
+                int(100 + 155 * (i / client_count)),
+                int(100 + 155 * (i / client_count))
             ))
-    
+        )
+        for i, (client_name, series) in enumerate(clients)
+    ])
+
     fig.update_layout(title='Total Count by Client Name for Each Month', xaxis_title='Month', yaxis_title='Total Count')
     
     return fig
@@ -0,0 +1,67 @@
+import pandas as pd
+
+# Label of the series that absorbs everything outside the top N
+OTHER_LABEL = 'Other'
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: indices of at most threshold points of
+    (x, y) that keep the visual shape of the line. x must be ascending.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    bucket = (n - 2) / (threshold - 2)
+    indices = [0]
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        # The average of the next bucket is the third corner of the triangle
+        next_end = min(int((i + 2) * bucket) + 1, n)
+        avg_x = sum(x[end:next_end]) / (next_end - end)
+        avg_y = sum(y[end:next_end]) / (next_end - end)
+        best, best_area = start, -1
+        for j in range(start, end):
+            area = abs((x[previous] - avg_x) * (y[j] - y[previous]) - (x[previous] - x[j]) * (avg_y - y[previous]))
+            if area > best_area:
+                best, best_area = j, area
+        indices.append(best)
+        previous = best
+    indices.append(n - 1)
+    return indices
+
+def top_n_series(df, time_column, series_columns, value_column, n):
+    """
+    Keep the n series with the highest total value_column and fold every
+    other series into one OTHER_LABEL series summed per time_column.
+    """
+    totals = df.groupby(series_columns)[value_column].sum()
+    if len(totals) <= n:
+        return df
+    keep = df.set_index(series_columns).index.isin(totals.nlargest(n).index)
+    other = df[~keep].groupby(time_column, as_index=False)[value_column].sum()
+    for column in series_columns:
+        other[column] = OTHER_LABEL
+    return pd.concat([df[keep], other[df.columns]], ignore_index=True)
+
+def downsample_series(df, time_column, series_columns, value_column, max_points):
+    """LTTB-downsample every series to at most max_points, ordered by time_column"""
+    df = df.sort_values(time_column)
+    parts = []
+    for _, series in df.groupby(series_columns, sort=False):
+        if len(series) > max_points:
+            x = pd.to_datetime(series[time_column]).astype('int64').tolist()
+            series = series.iloc[lttb_indices(x, series[value_column].tolist(), max_points)]
+        parts.append(series)
+    if not parts:
+        return df
+    return pd.concat(parts, ignore_index=True).sort_values(time_column, kind='stable')
+
+def reduce_series(df, time_column, series_columns, value_column, top_n=None, max_points=None):
+    """Apply the optional top-N cut-off and then the downsampling, as requested"""
+    if top_n:
+        df = top_n_series(df, time_column, series_columns, value_column, top_n)
+    if max_points:
+        df = downsample_series(df, time_column, series_columns, value_column, max_points)
+    return df
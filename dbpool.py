@@ -0,0 +1,85 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import weakref
+
+# Connection settings shared by app1.py, app2.py, apidata.py and apimetrics.py
+BUSY_TIMEOUT_SECONDS = 5
+CACHED_STATEMENTS = 256
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KB = 64 * 1024
+# Idle connections kept per database for the next thread; any beyond that are closed
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+
+connections = threading.local()
+idle = {}
+idle_lock = threading.Lock()
+
+def open_connection(db_path):
+    """Open a connection to db_path and apply the shared pragmas"""
+    # cached_statements keeps the prepared statements of repeated queries; connections
+    # move between threads, but only ever belong to one thread at a time
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS, cached_statements=CACHED_STATEMENTS,
+                           check_same_thread=False)
+    # WAL lets dashboard readers keep reading while a loader or upload writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    return conn
+
+def idle_queue(db_path):
+    with idle_lock:
+        return idle.setdefault(db_path, queue.LifoQueue(POOL_SIZE))
+
+class ThreadMarker:
+    """Kept in the thread-local state only so that its collection signals the thread has exited"""
+
+def release_connections(pool):
+    """Hand a finished thread's connections back to the idle queues"""
+    while pool:
+        db_path, conn = pool.popitem()
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            idle_queue(db_path).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def get_connection(db_path):
+    """
+    Return the calling thread's connection to db_path. The first call in a
+    thread takes an idle connection left by a finished thread, or opens one.
+    The Flask and Dash dev servers start a thread per request, so connections
+    go back to the idle queue when their thread exits rather than being
+    closed; callers must not close them.
+    """
+    pool = getattr(connections, 'pool', None)
+    if pool is None:
+        pool = connections.pool = {}
+        connections.marker = ThreadMarker()
+        weakref.finalize(connections.marker, release_connections, pool)
+    conn = pool.get(db_path)
+    if conn is None:
+        try:
+            conn = idle_queue(db_path).get_nowait()
+        except queue.Empty:
+            conn = open_connection(db_path)
+        pool[db_path] = conn
+    return conn
+
+def close_connections():
+    """Close the calling thread's connections and every idle one, e.g. at exit"""
+    release_connections(getattr(connections, 'pool', {}))
+    with idle_lock:
+        queues = list(idle.values())
+    for connection_queue in queues:
+        while True:
+            try:
+                connection_queue.get_nowait().close()
+            except queue.Empty:
+                break
+
+atexit.register(close_connections)
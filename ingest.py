@@ -0,0 +1,150 @@
+import argparse
+import csv
+import glob
+import importlib
+import itertools
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from dbpool import get_connection
+from usagedb import LOAD_CHUNK_SIZE, file_head_hash, record_source_file, source_file_id, write_transaction
+
+# App module whose parse_csv_rows and STAR_SCHEMA define the rows, and the database it serves
+TARGETS = {
+    'apidata': 'transactions.db',
+    'app2': 'data.db',
+    'apimetrics': 'apidata.db',
+}
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 4))
+# Parsed files waiting in the parent per worker; bounds memory to a few files' rows
+INGEST_QUEUE_PER_WORKER = 2
+
+def find_files(patterns):
+    """Expand directories and globs into a sorted list of CSV paths"""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.csv')
+        files.update(os.path.abspath(path) for path in glob.glob(pattern))
+    return sorted(files)
+
+def parse_file(target, path):
+    """
+    Parse and validate one CSV export in a worker process. Returns
+    (path, rows, fingerprint, seconds, error); a file with any invalid row
+    is rejected whole, with rows set to None.
+    """
+    module = importlib.import_module(target)
+    start = time.perf_counter()
+    stat = os.stat(path)
+    try:
+        with open(path, 'r', newline='') as csvfile:
+            rows = list(module.parse_csv_rows(csv.reader(csvfile)))
+    except (KeyError, ValueError, IndexError, StopIteration) as e:
+        return path, None, None, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    fingerprint = (stat.st_size, stat.st_mtime_ns, file_head_hash(path, stat.st_size))
+    return path, rows, fingerprint, time.perf_counter() - start, None
+
+def is_loaded(conn, path):
+    """Whether path is already in source_files with its current size and mtime"""
+    known = conn.execute('SELECT size, mtime_ns FROM source_files WHERE path = ?', (path,)).fetchone()
+    stat = os.stat(path)
+    return known is not None and known == (stat.st_size, stat.st_mtime_ns)
+
+def write_file(module, conn, path, rows, fingerprint):
+    """Insert one parsed file and record its fingerprint in a single transaction"""
+    cursor = conn.cursor()
+    with write_transaction(conn, module.analytics_store) as staged:
+        source_id = source_file_id(cursor, path)
+        for i in range(0, len(rows), LOAD_CHUNK_SIZE):
+            module.STAR_SCHEMA.insert_rows(cursor, rows[i:i + LOAD_CHUNK_SIZE], staged, source_id)
+        record_source_file(cursor, path, fingerprint, len(rows))
+
+def ingest(target, files, workers=INGEST_WORKERS):
+    """
+    Parse new CSV exports in a process pool and funnel them into a single
+    writer. Files loaded before that have since changed go through the
+    module's own load_data_from_csv, which handles appended tails and
+    rewrites. Prints rows/sec for the parse and write stages.
+    """
+    module = importlib.import_module(target)
+    module.create_database()
+    conn = get_connection(TARGETS[target])
+    known_paths = {row[0] for row in conn.execute('SELECT path FROM source_files')}
+
+    new_files = []
+    changed_files = []
+    for path in files:
+        if path not in known_paths:
+            new_files.append(path)
+        elif not is_loaded(conn, path):
+            changed_files.append(path)
+    print(f"{len(files)} files: {len(new_files)} new, {len(changed_files)} changed, "
+          f"{len(files) - len(new_files) - len(changed_files)} already loaded")
+
+    wall_start = time.perf_counter()
+    parse_seconds = write_seconds = 0.0
+    parsed_rows = total_rows = 0
+    failed = []
+    conn.execute('PRAGMA synchronous=OFF')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = iter(new_files)
+            in_flight = set()
+            while True:
+                # Only a bounded number of files are submitted at a time, so the
+                # parent never holds the parsed rows of every file at once
+                for path in itertools.islice(pending, workers * INGEST_QUEUE_PER_WORKER - len(in_flight)):
+                    in_flight.add(pool.submit(parse_file, target, path))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                # Writes happen here in the parent only, as each file finishes parsing
+                for future in done:
+                    path, rows, fingerprint, seconds, error = future.result()
+                    parse_seconds += seconds
+                    if error:
+                        failed.append(path)
+                        print(f"Rejected {path}: {error}")
+                        continue
+                    start = time.perf_counter()
+                    write_file(module, conn, path, rows, fingerprint)
+                    write_seconds += time.perf_counter() - start
+                    parsed_rows += len(rows)
+                    print(f"Loaded {len(rows)} rows from {path}")
+    finally:
+        conn.execute('PRAGMA synchronous=NORMAL')
+
+    for path in changed_files:
+        start = time.perf_counter()
+        loaded = module.load_data_from_csv(path)
+        write_seconds += time.perf_counter() - start
+        total_rows += loaded
+        print(f"Loaded {loaded} new rows from changed {path}")
+
+    total_rows += parsed_rows
+    wall = time.perf_counter() - wall_start
+    print(f"Parse: {parsed_rows / parse_seconds if parse_seconds else 0:,.0f} rows/sec per worker "
+          f"over {workers} workers ({parse_seconds:.1f}s CPU)")
+    print(f"Write: {total_rows / write_seconds if write_seconds else 0:,.0f} rows/sec ({write_seconds:.1f}s)")
+    print(f"Total: {total_rows} rows in {wall:.1f}s, {total_rows / wall if wall else 0:,.0f} rows/sec; "
+          f"{len(failed)} files rejected")
+    return total_rows, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Load usage CSV exports into an app database')
+    parser.add_argument('target', choices=sorted(TARGETS), help='app whose database and row format to use')
+    parser.add_argument('paths', nargs='+', help='CSV files, directories or glob patterns')
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help='parser processes')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if not files:
+        parser.error('no CSV files matched')
+    total_rows, failed = ingest(args.target, files, args.workers)
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,561 @@
+"""
+Worker log tailing and CloudWatch upload shared by processlog.py and
+Processlogs.py. Each script supplies its own put_events, file selection and
+entry point; the rest lives here.
+"""
+import os
+import time
+import re
+import calendar
+import sqlite3
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+
+LOG_DIR = "/actions-runner/_diag"
+LOG_GROUP = "/var/log"
+REGION = "us-east-2"
+COMPLETED_MARKER = "Job completed."
+# put_log_events limits: events per request, request payload bytes
+# (UTF-8 message bytes + 26 per event) and bytes per single event
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD_BYTES = 26
+MAX_EVENT_BYTES = 262144 - EVENT_OVERHEAD_BYTES
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
+# Runner diag lines start with "[YYYY-MM-DD HH:MM:SSZ INFO Worker] ..."
+TIMESTAMP_PATTERN = re.compile(r"\[(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})Z")
+TIMESTAMP_PREFIX_LEN = len("[YYYY-MM-DD HH:MM:SSZ")
+READ_CHUNK_SIZE = 1024 * 1024
+SCAN_OVERLAP = 512
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "16"))
+CHECKPOINT_DB = os.environ.get("CHECKPOINT_DB", "uploader_checkpoints.db")
+STREAM_CACHE_TTL = 3600
+STREAM_CACHE_WARM_LIMIT = 10000
+# Matches the completion marker or a job context entry's key and value, such
+# as "k": "run_id", "v": "123456789", with optional spaces/newlines
+SCAN_PATTERN = re.compile(
+    r'(?P<marker>' + re.escape(COMPLETED_MARKER) + r')'
+    r'|"k"\s*:\s*"(?P<key>run_id|repository|job)"\s*,\s*"v"\s*:\s*"(?P<value>[^"]*)"',
+    re.MULTILINE
+)
+
+# Upload lanes and dispatcher threads share one client; size its connection
+# pool so concurrent streams never queue for a connection
+client = boto3.client("logs", region_name=REGION, config=Config(max_pool_connections=UPLOAD_WORKERS * 2))
+
+# Keep track of already processed files
+processed_files = set()
+
+# Scan state per Worker log, so metadata is extracted once per file
+scanners = {}
+
+
+def log(msg, level="info"):
+    """Helper for consistent log formatting; each script configures logging's output"""
+    if level == "error":
+        logging.error(msg)
+    elif level == "warn":
+        logging.warning(msg)
+    else:
+        logging.info(msg)
+
+
+class LogStreamCache:
+    """
+    TTL cache of log streams known to exist in LOG_GROUP. Warmed at startup with
+    a paginated describe_log_streams over the most recently written streams, so
+    steady-state uploads make no create_log_stream calls.
+    """
+
+    def __init__(self, ttl=STREAM_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.expires = {}
+
+    def warm(self, limit=STREAM_CACHE_WARM_LIMIT):
+        try:
+            paginator = client.get_paginator("describe_log_streams")
+            pages = paginator.paginate(logGroupName=LOG_GROUP, orderBy="LastEventTime", descending=True,
+                                       PaginationConfig={"MaxItems": limit})
+            for page in pages:
+                for stream in page["logStreams"]:
+                    self.add(stream["logStreamName"])
+        except Exception as e:
+            log(f"⚠️ Could not warm log stream cache for {LOG_GROUP}: {e}", "warn")
+            return
+        log(f"Cached {len(self.expires)} existing log streams in {LOG_GROUP}")
+
+    def known(self, stream_name):
+        with self.lock:
+            return self.expires.get(stream_name, 0) > time.time()
+
+    def add(self, stream_name):
+        with self.lock:
+            self.expires[stream_name] = time.time() + self.ttl
+
+    def discard(self, stream_name):
+        with self.lock:
+            self.expires.pop(stream_name, None)
+
+
+stream_cache = LogStreamCache()
+
+
+def ensure_log_stream(run_id):
+    """Ensure log stream exists for this run_id, skipping the API call for cached streams"""
+    if stream_cache.known(str(run_id)):
+        return
+    try:
+        client.create_log_stream(logGroupName=LOG_GROUP, logStreamName=str(run_id))
+        log(f"Created log stream: {run_id}")
+    except client.exceptions.ResourceAlreadyExistsException:
+        log(f"Log stream already exists: {run_id}")
+    stream_cache.add(str(run_id))
+
+
+class WorkerLogScanner:
+    """
+    Single pass over a Worker log that picks up run_id, repository, job name and
+    the 'Job completed.' marker together. Text is fed as it is tailed; the last
+    SCAN_OVERLAP characters of each chunk are rescanned with the next one so an
+    entry split across a chunk boundary is still matched.
+    """
+
+    def __init__(self):
+        self.metadata = {}
+        self.completed = False
+        self.carry = ""
+
+    def feed(self, text):
+        window = self.carry + text
+        for match in SCAN_PATTERN.finditer(window):
+            if match.group("marker"):
+                self.completed = True
+            elif match.group("key") != "run_id" or match.group("value").isdigit():
+                self.metadata.setdefault(match.group("key"), match.group("value"))
+        self.carry = window[-SCAN_OVERLAP:]
+
+    @property
+    def run_id(self):
+        return self.metadata.get("run_id")
+
+
+class WorkerLogTailer:
+    """
+    Follow a Worker log by byte offset.
+    Each read_lines() call reads only bytes appended since the previous call and
+    returns the complete lines among them; a trailing partial line is held back
+    until its newline arrives, so every byte is read from disk once.
+    """
+
+    def __init__(self, file_path, offset=0):
+        self.file_path = file_path
+        self.offset = offset
+        self.partial = b""
+
+    def read_lines(self, max_bytes=READ_CHUNK_SIZE):
+        with open(self.file_path, "rb") as f:
+            f.seek(self.offset)
+            chunk = f.read(max_bytes)
+        if not chunk:
+            return []
+        self.offset += len(chunk)
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        return [line.decode("utf-8", errors="replace") for line in lines]
+
+    def read_remaining(self):
+        """Drain everything written so far, including a final unterminated line"""
+        lines = []
+        while True:
+            offset = self.offset
+            lines.extend(self.read_lines())
+            if self.offset == offset:
+                break
+        if self.partial:
+            lines.append(self.partial.decode("utf-8", errors="replace"))
+            self.partial = b""
+        return lines
+
+
+class CheckpointStore:
+    """
+    Durable per-file upload progress kept in SQLite, so a restart resumes each
+    Worker log from its last uploaded offset instead of re-shipping it.
+    Files are identified by path and inode; the size and mtime recorded when a
+    file is marked done tell whether it has changed since.
+    """
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                file_path TEXT PRIMARY KEY,
+                inode INTEGER,
+                size INTEGER,
+                mtime REAL,
+                offset INTEGER DEFAULT 0,
+                run_id TEXT,
+                sequence_token TEXT,
+                done INTEGER DEFAULT 0
+            )
+        ''')
+        self.conn.commit()
+
+    def load(self, file_path):
+        """Return the checkpoint for file_path, or None if it is unknown, replaced or truncated"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT inode, size, mtime, offset, run_id, sequence_token, done FROM checkpoints WHERE file_path = ?",
+                (file_path,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        inode, size, mtime, offset, run_id, sequence_token, done = row
+        if st.st_ino != inode or st.st_size < offset:
+            return None
+        return {
+            "offset": offset,
+            "run_id": run_id,
+            "sequence_token": sequence_token,
+            "done": bool(done) and st.st_size == size and st.st_mtime == mtime,
+        }
+
+    def save(self, file_path, offset, run_id, sequence_token):
+        """Record that everything before offset has been uploaded to the run_id stream"""
+        st = os.stat(file_path)
+        with self.lock:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO checkpoints (file_path, inode, size, mtime, offset, run_id, sequence_token, done)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (file_path, st.st_ino, st.st_size, st.st_mtime, offset, run_id, sequence_token))
+            self.conn.commit()
+
+    def mark_done(self, file_path):
+        """Record that file_path needs no further processing unless it changes"""
+        st = os.stat(file_path)
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO checkpoints (file_path, inode, size, mtime, offset, done)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT(file_path) DO UPDATE SET
+                    inode = excluded.inode, size = excluded.size, mtime = excluded.mtime, done = 1
+            ''', (file_path, st.st_ino, st.st_size, st.st_mtime, st.st_size))
+            self.conn.commit()
+
+
+checkpoints = CheckpointStore(CHECKPOINT_DB)
+
+
+def split_message(message):
+    """Split a message into (text, byte size) pieces that fit the per-event size limit"""
+    data = message.encode("utf-8")
+    if len(data) <= MAX_EVENT_BYTES:
+        return [(message, len(data))]
+    pieces = []
+    start = 0
+    while start < len(data):
+        end = min(start + MAX_EVENT_BYTES, len(data))
+        # Back off so a multi-byte character is never cut in half
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        pieces.append((data[start:end].decode("utf-8"), end - start))
+        start = end
+    return pieces
+
+
+def pack_batches(log_events):
+    """
+    Pack chronologically sorted events into put_log_events requests filled up to
+    both the event count and payload byte limits, splitting events larger than
+    the per-event limit and never letting one request span more than 24 hours.
+    """
+    batch = []
+    batch_bytes = 0
+    for event in log_events:
+        for message, size in split_message(event["message"]):
+            size += EVENT_OVERHEAD_BYTES
+            if batch and (len(batch) == MAX_BATCH_EVENTS or batch_bytes + size > MAX_BATCH_BYTES
+                          or event["timestamp"] - batch[0]["timestamp"] > MAX_BATCH_SPAN_MS):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append({"timestamp": event["timestamp"], "message": message})
+            batch_bytes += size
+    if batch:
+        yield batch
+
+
+def rejected_events(batch, info):
+    """
+    The events of a chronologically sorted batch that put_log_events reported in
+    rejectedLogEventsInfo: a leading run too old or past retention, and a
+    trailing run too far in the future.
+    """
+    if not info:
+        return []
+    old_end = max(info.get("tooOldLogEventEndIndex", 0), info.get("expiredLogEventEndIndex", 0))
+    new_start = max(info.get("tooNewLogEventStartIndex", len(batch)), old_end)
+    return batch[:old_end] + batch[new_start:]
+
+
+def send_batch(run_id, batch, sequence_token=None):
+    kwargs = {
+        "logGroupName": LOG_GROUP,
+        "logStreamName": str(run_id),
+        "logEvents": batch,
+    }
+    if sequence_token:
+        kwargs["sequenceToken"] = sequence_token
+    return client.put_log_events(**kwargs)
+
+
+def put_batch(run_id, batch, sequence_token=None):
+    """
+    Send a single packed batch, returning the next sequence token. CloudWatch
+    accepts the request but drops events outside its time window (over 14 days
+    old, past the group's retention or over 2 hours ahead); those are sent again
+    stamped with the current time, as their lines still carry the runner's own
+    timestamp.
+    """
+    resp = send_batch(run_id, batch, sequence_token)
+    rejected = rejected_events(batch, resp.get("rejectedLogEventsInfo"))
+    if rejected:
+        log(f"⚠️ CloudWatch rejected {len(rejected)} events for stream {run_id} as outside its time window, "
+            f"resending them stamped with the current time", "warn")
+        now_ms = int(time.time() * 1000)
+        restamped = [{"timestamp": now_ms, "message": event["message"]} for event in rejected]
+        resp = send_batch(run_id, restamped, resp.get("nextSequenceToken"))
+        if resp.get("rejectedLogEventsInfo"):
+            log(f"❌ CloudWatch rejected {len(rejected)} restamped events for stream {run_id}: "
+                f"{resp['rejectedLogEventsInfo']}", "error")
+    return resp.get("nextSequenceToken")
+
+
+def put_events(run_id, log_events, sequence_token=None):
+    """Send log_events to the run_id stream in packed batches, returning the next sequence token"""
+    log_events = sorted(log_events, key=lambda event: event["timestamp"])
+    for batch in pack_batches(log_events):
+        sequence_token = put_batch(run_id, batch, sequence_token)
+    return sequence_token
+
+
+class LineTimestamper:
+    """
+    Turn the runner's "[YYYY-MM-DD HH:MM:SSZ ..." line prefix into epoch milliseconds.
+    Lines without a prefix (stack traces, JSON bodies) inherit the previous line's
+    time, or None if no prefix has been seen yet. Consecutive lines usually share
+    a second, so the last prefix is cached and only a changed prefix goes through
+    the regex and date conversion.
+    """
+
+    def __init__(self):
+        self.last_ms = None
+        self.cached_prefix = None
+
+    def timestamp(self, line):
+        prefix = line[:TIMESTAMP_PREFIX_LEN]
+        if prefix != self.cached_prefix:
+            match = TIMESTAMP_PATTERN.match(prefix)
+            if match:
+                self.cached_prefix = prefix
+                self.last_ms = calendar.timegm(tuple(int(part) for part in match.groups())) * 1000
+        return self.last_ms
+
+
+def to_events(lines, timestamper):
+    """
+    Turn raw lines into timestamped CloudWatch events, dropping blank ones.
+    Lines ahead of the first parseable prefix take the first timestamp found.
+    """
+    events = [{"timestamp": timestamper.timestamp(line), "message": line.strip()} for line in lines if line.strip()]
+    if events and events[0]["timestamp"] is None:
+        first_ms = next((event["timestamp"] for event in events if event["timestamp"] is not None), None)
+        first_ms = first_ms or int(time.time() * 1000)
+        for event in events:
+            if event["timestamp"] is not None:
+                break
+            event["timestamp"] = first_ms
+    return events
+
+
+class StreamLanes:
+    """
+    Upload backend with one ordered lane per log stream. Work submitted for the
+    same stream runs one item at a time in submission order (several Worker logs
+    of one workflow run share a run_id stream), while different streams upload
+    in parallel on a shared pool.
+    """
+
+    def __init__(self, max_workers=UPLOAD_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lane")
+        self.lock = threading.Lock()
+        self.lanes = {}
+
+    def submit(self, stream, fn, *args):
+        future = Future()
+        with self.lock:
+            lane = self.lanes.get(stream)
+            idle = lane is None
+            if idle:
+                lane = self.lanes[stream] = deque()
+            lane.append((fn, args, future))
+        if idle:
+            self.executor.submit(self._drain, stream)
+        return future
+
+    def _drain(self, stream):
+        while True:
+            with self.lock:
+                lane = self.lanes[stream]
+                if not lane:
+                    del self.lanes[stream]
+                    return
+                fn, args, future = lane.popleft()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+lanes = StreamLanes()
+
+
+def finish_upload(file_path, run_id, in_flight):
+    """Wait for an in-flight upload and checkpoint the offset it covered"""
+    future, offset = in_flight
+    sequence_token = future.result()
+    checkpoints.save(file_path, offset, run_id, sequence_token)
+    return sequence_token
+
+
+def follow_and_upload(file_path, put_events=put_events, timeout=300, interval=5, fallback_run_id=None):
+    """
+    Tail a Worker log and ship its lines to CloudWatch as they are appended,
+    each batch sent by put_events(run_id, events, sequence_token).
+    Returns True once 'Job completed.' has been read, False if the file stops
+    growing for `timeout` seconds first. Lines read before the run_id shows up
+    are held until the stream name is known; a job that completes without one
+    goes to the fallback_run_id stream, or is skipped if that is None.
+    Progress is checkpointed after every upload and resumed from on restart.
+    Each batch uploads on the stream's lane while the next chunk is read.
+    Read and upload errors are raised to the caller.
+    """
+    checkpoint = checkpoints.load(file_path) or {"offset": 0, "run_id": None, "sequence_token": None}
+    tailer = WorkerLogTailer(file_path, offset=checkpoint["offset"])
+    run_id = checkpoint["run_id"]
+    scanner = scanners.setdefault(file_path, WorkerLogScanner())
+    timestamper = LineTimestamper()
+    pending = []
+    in_flight = None
+    sequence_token = checkpoint["sequence_token"]
+    uploaded = 0
+    completed = False
+    last_growth = time.time()
+    if run_id:
+        log(f"Resuming {file_path} at byte {tailer.offset} -> stream {run_id}")
+
+    while not completed:
+        offset = tailer.offset
+        lines = tailer.read_lines()
+        if tailer.offset == offset:
+            if time.time() - last_growth >= timeout:
+                break
+            time.sleep(interval)
+            continue
+        last_growth = time.time()
+
+        scanner.feed("".join(line + "\n" for line in lines))
+        if run_id is None and scanner.run_id:
+            run_id = scanner.run_id
+            log(f"Found run_id: {run_id} in {file_path} "
+                f"(repository: {scanner.metadata.get('repository')}, job: {scanner.metadata.get('job')})")
+            ensure_log_stream(run_id)
+
+        if scanner.completed:
+            log(f"'Job completed.' found in {file_path}")
+            completed = True
+            lines.extend(tailer.read_remaining())
+
+        pending.extend(to_events(lines, timestamper))
+        if run_id is None and completed and fallback_run_id:
+            log(f"⚠️ run_id not found in {file_path}, uploading to stream {fallback_run_id}", "warn")
+            run_id = fallback_run_id
+            ensure_log_stream(run_id)
+        if run_id and pending:
+            if in_flight:
+                sequence_token = finish_upload(file_path, run_id, in_flight)
+            in_flight = (lanes.submit(run_id, put_events, run_id, pending, sequence_token),
+                         tailer.offset - len(tailer.partial))
+            uploaded += len(pending)
+            pending = []
+
+    if in_flight:
+        finish_upload(file_path, run_id, in_flight)
+
+    if not completed:
+        log(f"⚠️ Timeout waiting for 'Job completed.' in {file_path}", "warn")
+    if run_id is None:
+        log(f"⚠️ run_id not found in {file_path}, skipping upload", "warn")
+    else:
+        log(f"✅ Uploaded {uploaded} lines from {file_path} -> stream {run_id}")
+    return completed
+
+
+def mark_processed(file_path):
+    """Record that a Worker log has been uploaded in full, here and in its checkpoint"""
+    processed_files.add(file_path)
+    checkpoints.mark_done(file_path)
+    scanners.pop(file_path, None)
+
+
+class UploadDispatcher:
+    """
+    Queue detected Worker logs and run process_worker_log on each in a bounded
+    thread pool, so a slow job never holds up detection or upload of the other
+    logs.
+    Tracks per-file state ("queued", "running", "done", "failed") to avoid
+    processing the same file twice when watchdog and the startup scan overlap.
+    """
+
+    def __init__(self, process_worker_log, max_workers=UPLOAD_WORKERS):
+        self.process_worker_log = process_worker_log
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="uploader")
+        self.lock = threading.Lock()
+        self.file_states = {}
+
+    def submit(self, file_path):
+        with self.lock:
+            if file_path in processed_files or self.file_states.get(file_path) in ("queued", "running"):
+                return False
+            self.file_states[file_path] = "queued"
+        self.executor.submit(self._run, file_path)
+        return True
+
+    def _run(self, file_path):
+        with self.lock:
+            self.file_states[file_path] = "running"
+        try:
+            self.process_worker_log(file_path)
+        except Exception as e:
+            log(f"❌ Unexpected error processing {file_path}: {e}", "error")
+        finally:
+            with self.lock:
+                self.file_states[file_path] = "done" if file_path in processed_files else "failed"
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
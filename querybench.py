@@ -0,0 +1,159 @@
+import os
+import random
+import sqlite3
+import statistics
+import time
+
+from apidata import SCHEMA_MIGRATIONS, EXPORT_BATCH_SIZE
+from usagedb import migrate_database
+
+# Size of the synthetic transactions table, overridable from the environment
+BENCH_DB = os.environ.get("BENCH_DB", "querybench.db")
+BENCH_ROWS = int(os.environ.get("BENCH_ROWS", "1000000"))
+BENCH_CLIENTS = 500
+BENCH_FUNCTIONS = 200
+BENCH_MONTHS = 36
+BENCH_REPEAT = 5
+# Rows per Tab 3 page in apimetrics.py
+BENCH_PAGE_SIZE = 10
+
+def build_table(conn):
+    """Create the pre-migration (user_version 0) transactions table filled with synthetic rows"""
+    conn.execute('''
+        CREATE TABLE transactions (
+            month INTEGER,
+            year INTEGER,
+            clientid TEXT,
+            mal_code TEXT,
+            uri TEXT,
+            count INTEGER,
+            business_function TEXT,
+            client_name TEXT,
+            date TEXT
+        )
+    ''')
+    rng = random.Random(42)
+    def rows():
+        for _ in range(BENCH_ROWS):
+            offset = rng.randrange(BENCH_MONTHS)
+            year, month = 2023 + offset // 12, offset % 12 + 1
+            client = f"client{rng.randrange(BENCH_CLIENTS)}"
+            uri = f"/api/v1/function{rng.randrange(BENCH_FUNCTIONS)}"
+            yield (month, year, client, "MAL1", uri, rng.randrange(1, 1000), uri, client, f"{year}-{month:02d}")
+    with conn:
+        conn.executemany('INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+
+def time_query(conn, query, params=()):
+    """Median wall time in milliseconds over BENCH_REPEAT runs"""
+    timings = []
+    for _ in range(BENCH_REPEAT):
+        start = time.perf_counter()
+        conn.execute(query, params).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def query_plan(conn, query, params=()):
+    return '; '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params))
+
+def run_queries(conn, queries):
+    """Time each (query, params) in queries and print it with its plan"""
+    results = {}
+    for name, (query, params) in queries.items():
+        results[name] = time_query(conn, query, params)
+        print(f"  {name:28} {results[name]:9.1f} ms  [{query_plan(conn, query, params)}]")
+    return results
+
+def in_list(values):
+    return ','.join('?' * len(values))
+
+def baseline_queries():
+    """The dashboard queries as they ran against the original wide table"""
+    clients = [f"client{i}" for i in range(0, BENCH_CLIENTS, 50)]
+    functions = [f"/api/v1/function{i}" for i in range(0, BENCH_FUNCTIONS, 20)]
+    return {
+        'get_data': (f'''
+            SELECT date, SUM(count), client_name, business_function
+            FROM transactions
+            WHERE client_name IN ({in_list(clients)})
+            AND business_function IN ({in_list(functions)})
+            AND date BETWEEN ? AND ?
+            GROUP BY date, client_name, business_function
+            ORDER BY date
+        ''', clients + functions + ['2023-06', '2024-06']),
+        'distinct client_name': ('SELECT DISTINCT client_name FROM transactions', ()),
+        'distinct business_function': ('SELECT DISTINCT business_function FROM transactions', ()),
+        'get_transactions page': (f'''
+            SELECT date, client_name, business_function, count
+            FROM transactions
+            WHERE date >= ? AND date <= ? AND client_name IN ({in_list(clients)})
+            LIMIT ?
+        ''', ['2023-06', '2024-06'] + clients + [EXPORT_BATCH_SIZE]),
+        'tab3 count': ('SELECT COUNT(*) FROM transactions', ()),
+        'tab3 page by client_name': ('''
+            SELECT month, year, clientid, mal_code, uri, count, business_function, client_name
+            FROM transactions ORDER BY client_name, rowid LIMIT ? OFFSET ?
+        ''', [BENCH_PAGE_SIZE, 100 * BENCH_PAGE_SIZE]),
+    }
+
+def current_queries():
+    """The same requests as the apps now run them against the migrated schema"""
+    clients = [f"client{i}" for i in range(0, BENCH_CLIENTS, 50)]
+    functions = [f"/api/v1/function{i}" for i in range(0, BENCH_FUNCTIONS, 20)]
+    return {
+        'get_data': (f'''
+            SELECT printf('%04d-%02d', month_key / 100, month_key % 100), total_count, client_name, business_function
+            FROM monthly_rollup
+            WHERE client_name IN ({in_list(clients)})
+            AND business_function IN ({in_list(functions)})
+            AND month_key BETWEEN ? AND ?
+            ORDER BY month_key
+        ''', clients + functions + [202306, 202406]),
+        'distinct client_name': ('SELECT DISTINCT client_name FROM monthly_rollup', ()),
+        'distinct business_function': ('SELECT DISTINCT business_function FROM monthly_rollup', ()),
+        'get_transactions page': (f'''
+            SELECT f.rowid, printf('%04d-%02d', f.year, f.month), c.client_name, u.business_function, f.count
+            FROM transaction_facts f
+            JOIN clients c ON c.id = f.client_key
+            JOIN uris u ON u.id = f.uri_key
+            WHERE f.rowid > ? AND +f.month_key >= ? AND +f.month_key <= ?
+            AND +f.client_key IN (SELECT id FROM clients WHERE client_name IN ({in_list(clients)}))
+            ORDER BY f.rowid
+            LIMIT ?
+        ''', [0, 202306, 202406] + clients + [EXPORT_BATCH_SIZE]),
+        'tab3 count': ('SELECT COUNT(*) FROM transaction_facts', ()),
+        'tab3 page by client_name': ('''
+            SELECT month, year, clientid, mal_code, uri, count, business_function, client_name
+            FROM transactions
+            WHERE rowid IN (
+                SELECT f.rowid FROM transaction_facts f JOIN clients c ON c.id = f.client_key
+                ORDER BY c.client_name, f.rowid LIMIT ? OFFSET ?
+            )
+            ORDER BY client_name, rowid
+        ''', [BENCH_PAGE_SIZE, 100 * BENCH_PAGE_SIZE]),
+    }
+
+def main():
+    if os.path.exists(BENCH_DB):
+        os.remove(BENCH_DB)
+    conn = sqlite3.connect(BENCH_DB)
+    print(f"Building {BENCH_ROWS} rows in {BENCH_DB}")
+    build_table(conn)
+
+    print("Before migrations (wide table, string date filter, no indexes):")
+    before = run_queries(conn, baseline_queries())
+
+    start = time.perf_counter()
+    migrate_database(conn, SCHEMA_MIGRATIONS)
+    print(f"Migrated to user_version {conn.execute('PRAGMA user_version').fetchone()[0]} "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    print("After migrations (rollup, star schema and its indexes):")
+    after = run_queries(conn, current_queries())
+
+    for name in before:
+        print(f"  {name:28} {before[name] / after[name]:6.1f}x faster")
+    conn.close()
+    os.remove(BENCH_DB)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,477 @@
+import collections
+import contextlib
+import csv
+import hashlib
+import io
+import itertools
+import os
+import threading
+import time
+
+from analytics import staged_transaction
+from dbpool import get_connection
+
+# Helpers shared by app2.py, apidata.py and apimetrics.py, whose usage databases
+# have the same rollup, source_files and dimension tables
+
+# Query results kept in memory between identical dashboard requests
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL = 300
+# Dimension keys looked up per IN (...) query while interning a batch
+INTERN_LOOKUP_SIZE = 500
+# Rows per executemany call when bulk loading a CSV export
+LOAD_CHUNK_SIZE = 50000
+# Bytes read per block when hashing a CSV export to tell an append from a rewrite
+HASH_BLOCK_BYTES = 1 << 20
+
+def migrate_database(conn, migrations, target_version=None):
+    """
+    Apply the migrations newer than the database's PRAGMA user_version, up to
+    target_version. Returns the number of migrations applied.
+    """
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    pending = migrations[version:target_version]
+    for target, statements in enumerate(pending, start=version + 1):
+        conn.execute('BEGIN')
+        with conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {target}')
+    return len(pending)
+
+def bump_data_version(cursor):
+    """Advance the database's data version, which QueryCache entries are checked against"""
+    cursor.execute('UPDATE data_version SET version = version + 1')
+
+@contextlib.contextmanager
+def write_transaction(conn, store=None):
+    """
+    A staged_transaction for changes to usage data, which also advances
+    data_version. Without a mirror the bump commits with the data; with one
+    it is committed once the new mirror version is published, so no query
+    reads the old mirror and caches its result under the new version.
+    """
+    with staged_transaction(conn, store) as staged:
+        yield staged
+        if store is None:
+            bump_data_version(conn)
+    if store is not None:
+        with conn:
+            bump_data_version(conn)
+
+class QueryCache:
+    """
+    LRU cache of query results with a TTL, for one database. Each entry keeps
+    the data_version it was computed at and is only reused while the database
+    is still at that version, so writes from any process (uploads, loads,
+    ingest.py runs) invalidate it as soon as they commit.
+    """
+
+    def __init__(self, db_path, maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        # Read before computing, so a write committed meanwhile leaves the new entry already stale
+        version = get_connection(self.db_path).execute('SELECT version FROM data_version').fetchone()[0]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == version and time.time() - entry[1] < self.ttl:
+                self.entries.move_to_end(key)
+                return entry[2]
+        value = compute()
+        with self.lock:
+            self.entries[key] = (version, time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+def rebuild_rollup(cursor, table, month_keys=None):
+    """
+    Recompute monthly_rollup from table, e.g. after client or function names
+    are remapped, or only the months in month_keys. Rows with no name are
+    totalled under '', as the rollup's key columns can't hold NULL; rows with
+    no month (an unparseable date) can't be charted, so are left out.
+    """
+    where, params = 'WHERE month_key IS NOT NULL', []
+    if month_keys is not None:
+        params = list(month_keys)
+        where = f"WHERE month_key IN ({','.join(['?'] * len(params))})"
+        cursor.execute(f'DELETE FROM monthly_rollup {where}', params)
+    else:
+        cursor.execute('DELETE FROM monthly_rollup')
+    cursor.execute(f'''
+        INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+        SELECT month_key, IFNULL(client_name, ''), IFNULL(business_function, ''), SUM(count)
+        FROM {table}
+        {where}
+        GROUP BY 1, 2, 3
+    ''', params)
+
+def regroup_rollup(cursor, table, column, names):
+    """
+    Recompute just the monthly_rollup rows whose column (client_name or
+    business_function) is one of names, e.g. the old and new names of
+    remapped keys. The '' name also covers the view's NULL names.
+    """
+    names = sorted({name or '' for name in names})
+    for i in range(0, len(names), INTERN_LOOKUP_SIZE):
+        chunk = names[i:i + INTERN_LOOKUP_SIZE]
+        marks = ','.join(['?'] * len(chunk))
+        cursor.execute(f'DELETE FROM monthly_rollup WHERE {column} IN ({marks})', chunk)
+        nulls = f' OR {column} IS NULL' if '' in chunk else ''
+        cursor.execute(f'''
+            INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+            SELECT month_key, IFNULL(client_name, ''), IFNULL(business_function, ''), SUM(count)
+            FROM {table}
+            WHERE ({column} IN ({marks}){nulls}) AND month_key IS NOT NULL
+            GROUP BY 1, 2, 3
+        ''', chunk)
+
+# Fact table column holding each dimension's key
+DIMENSION_KEYS = {'clients': 'client_key', 'uris': 'uri_key'}
+
+def remap_dimension(cursor, schema, dimension, key_column, name_column, pairs, staged=None):
+    """
+    Apply (key, name) pairs to a dimension (clients or uris) with one UPDATE,
+    then regroup only the rollup rows under those keys' old and new names and
+    rename them in only the mirror months they have rows in. Returns the
+    number of dimension rows updated.
+    """
+    # Connections are reused, so clear out a mapping left by an earlier upload
+    cursor.execute('DROP TABLE IF EXISTS temp.mapping')
+    cursor.execute('CREATE TEMP TABLE mapping (key TEXT PRIMARY KEY, value TEXT)')
+    # Later rows win, same as applying the file top to bottom
+    cursor.executemany('INSERT OR REPLACE INTO mapping (key, value) VALUES (?, ?)', pairs)
+    mapping = dict(cursor.execute('SELECT key, value FROM mapping').fetchall())
+    names = set(mapping.values())
+    names.update(row[0] for row in cursor.execute(
+        f'SELECT {name_column} FROM {dimension} WHERE {key_column} IN (SELECT key FROM mapping)').fetchall())
+    month_keys = [row[0] for row in cursor.execute(f'''
+        SELECT DISTINCT month_key FROM {schema.facts_table}
+        WHERE {DIMENSION_KEYS[dimension]} IN (SELECT id FROM {dimension} WHERE {key_column} IN (SELECT key FROM mapping))
+        AND month_key IS NOT NULL
+    ''').fetchall()]
+    cursor.execute(f'''
+        UPDATE {dimension}
+        SET {name_column} = (SELECT value FROM mapping WHERE mapping.key = {dimension}.{key_column})
+        WHERE {key_column} IN (SELECT key FROM mapping)
+    ''')
+    updated = cursor.rowcount
+    regroup_rollup(cursor, schema.table, name_column, names)
+    if staged:
+        staged.rename(key_column, name_column, mapping, month_keys)
+    return updated
+
+def intern_members(cursor, table, key_column, name_column, members):
+    """
+    Intern a batch's distinct dimension values: members maps each key to its
+    default name (ignored when name_column is None). New keys are added with
+    that name; existing ones keep theirs. A None key, from a blank cell, maps
+    to the dimension's single NULL row. Returns {key: (id, name)}.
+    """
+    members = dict(members)
+    interned = {}
+    if None in members:
+        # UNIQUE admits any number of NULLs and IN (...) never matches one, so look it up with IS NULL
+        name = members.pop(None)
+        found = cursor.execute(f'SELECT id, {name_column or key_column} FROM {table} WHERE {key_column} IS NULL').fetchone()
+        if found is None:
+            if name_column:
+                cursor.execute(f'INSERT INTO {table} ({key_column}, {name_column}) VALUES (NULL, ?)', (name,))
+            else:
+                cursor.execute(f'INSERT INTO {table} ({key_column}) VALUES (NULL)')
+                name = None
+            found = (cursor.lastrowid, name)
+        interned[None] = found
+    if name_column:
+        cursor.executemany(f'INSERT OR IGNORE INTO {table} ({key_column}, {name_column}) VALUES (?, ?)',
+                           list(members.items()))
+    else:
+        name_column = key_column
+        cursor.executemany(f'INSERT OR IGNORE INTO {table} ({key_column}) VALUES (?)', [(key,) for key in members])
+    keys = list(members)
+    for i in range(0, len(keys), INTERN_LOOKUP_SIZE):
+        chunk = keys[i:i + INTERN_LOOKUP_SIZE]
+        query = f"SELECT {key_column}, id, {name_column} FROM {table} WHERE {key_column} IN ({','.join(['?'] * len(chunk))})"
+        for key, key_id, name in cursor.execute(query, chunk).fetchall():
+            interned[key] = (key_id, name)
+    return interned
+
+def update_rollup(cursor, rows):
+    """Add the counts of freshly inserted rows (tuples in analytics.COLUMNS order) into monthly_rollup"""
+    totals = collections.Counter()
+    for month_key, clientid, mal_code, uri, count, business_function, client_name in rows:
+        if month_key is None:
+            # Left out like in rebuild_rollup, as there's no month to chart it under
+            continue
+        # Nameless rows go under '', the same as rebuild_rollup
+        totals[(month_key, client_name or '', business_function or '')] += count
+    cursor.executemany('''
+        INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (month_key, client_name, business_function)
+        DO UPDATE SET total_count = total_count + excluded.total_count
+    ''', [(*group, total) for group, total in totals.items()])
+
+# View columns that come from the dimensions rather than the fact table
+DIMENSION_COLUMNS = {
+    'clientid': 'c.clientid',
+    'client_name': 'c.client_name',
+    'uri': 'u.uri',
+    'business_function': 'u.business_function',
+    'mal_code': 'm.mal_code',
+}
+
+class StarSchema:
+    """
+    One app's usage table in star schema form: facts_table holds the plain
+    columns plus integer keys into the clients, uris and mal_codes dimensions,
+    and a view under the original table name joins the names back in.
+    row_columns names the fields of the app's parsed rows in order,
+    fact_columns maps each plain fact column to its type, and
+    view_expressions gives the view columns computed from the facts.
+    """
+
+    def __init__(self, table, facts_table, row_columns, fact_columns, view_expressions=None):
+        self.table = table
+        self.facts_table = facts_table
+        self.row_columns = row_columns
+        self.fact_columns = fact_columns
+        self.view_expressions = view_expressions or {}
+        self.position = {name: i for i, name in enumerate(row_columns)}
+
+    def view_column(self, name):
+        if name in DIMENSION_COLUMNS:
+            return DIMENSION_COLUMNS[name]
+        if name in self.view_expressions:
+            return f'{self.view_expressions[name]} AS {name}'
+        return f'f.{name}'
+
+    def migrations(self):
+        """
+        Migrations 5-8 for the wide table: the star schema, its indexes,
+        source file tracking and the data version.
+        """
+        table, facts = self.table, self.facts_table
+        plain = list(self.fact_columns)
+        return [
+            # 5: star schema: facts keep integer keys into client, uri and mal_code dimensions
+            [
+                'CREATE TABLE clients (id INTEGER PRIMARY KEY, clientid TEXT UNIQUE, client_name TEXT)',
+                'CREATE TABLE uris (id INTEGER PRIMARY KEY, uri TEXT UNIQUE, business_function TEXT)',
+                'CREATE TABLE mal_codes (id INTEGER PRIMARY KEY, mal_code TEXT UNIQUE)',
+                f'INSERT INTO clients (clientid, client_name) SELECT clientid, MAX(client_name) FROM {table} GROUP BY clientid',
+                f'INSERT INTO uris (uri, business_function) SELECT uri, MAX(business_function) FROM {table} GROUP BY uri',
+                f'INSERT INTO mal_codes (mal_code) SELECT DISTINCT mal_code FROM {table}',
+                f'''CREATE TABLE {facts} (
+                    {', '.join(f'{name} {kind}' for name, kind in self.fact_columns.items())},
+                    client_key INTEGER REFERENCES clients (id),
+                    mal_code_key INTEGER REFERENCES mal_codes (id),
+                    uri_key INTEGER REFERENCES uris (id)
+                )''',
+                # Keep the rowids, so keyset cursors and the search index still line up;
+                # IS matches the NULL keys of blank cells too
+                f'''INSERT INTO {facts} (rowid, {', '.join(plain)}, client_key, mal_code_key, uri_key)
+                SELECT t.rowid, {', '.join('t.' + name for name in plain)}, c.id, m.id, u.id
+                FROM {table} t
+                JOIN clients c ON c.clientid IS t.clientid
+                JOIN uris u ON u.uri IS t.uri
+                JOIN mal_codes m ON m.mal_code IS t.mal_code''',
+                f'DROP TABLE {table}',
+                # The old table name stays readable as a view joining the dimensions back in
+                f'''CREATE VIEW {table} AS
+                SELECT f.rowid AS rowid, {', '.join(self.view_column(name) for name in self.row_columns)}
+                FROM {facts} f
+                JOIN clients c ON c.id = f.client_key
+                JOIN uris u ON u.id = f.uri_key
+                JOIN mal_codes m ON m.id = f.mal_code_key''',
+                # Each clientid and uri now has a single name, so the totals are regrouped under it
+                'DELETE FROM monthly_rollup',
+                f'''INSERT INTO monthly_rollup (month_key, client_name, business_function, total_count)
+                SELECT month_key, IFNULL(client_name, ''), IFNULL(business_function, ''), SUM(count)
+                FROM {table}
+                WHERE month_key IS NOT NULL
+                GROUP BY 1, 2, 3''',
+            ],
+            # 6: indexes on the facts and names, which went with the wide table dropped in 5
+            [
+                f'CREATE INDEX IF NOT EXISTS idx_{facts}_month ON {facts} (month_key)',
+                f'CREATE INDEX IF NOT EXISTS idx_{facts}_client ON {facts} (client_key)',
+                f'CREATE INDEX IF NOT EXISTS idx_{facts}_uri ON {facts} (uri_key)',
+                'CREATE INDEX IF NOT EXISTS idx_clients_name ON clients (client_name)',
+                'CREATE INDEX IF NOT EXISTS idx_uris_function ON uris (business_function)',
+            ],
+            # 7: facts remember the source file they were loaded from, so rewriting one
+            # export replaces only its own rows; uploads have no source file
+            [
+                '''CREATE TABLE source_files_new (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT UNIQUE,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    head_hash TEXT,
+                    rows INTEGER
+                )''',
+                '''INSERT INTO source_files_new (path, size, mtime_ns, head_hash, rows)
+                SELECT path, size, mtime_ns, head_hash, rows FROM source_files''',
+                'DROP TABLE source_files',
+                'ALTER TABLE source_files_new RENAME TO source_files',
+                f'ALTER TABLE {facts} ADD COLUMN source_file_id INTEGER REFERENCES source_files (id)',
+                # Earlier rows can only be attributed when a single file has been loaded,
+                # which is how the app's own startup load of its one export left them
+                f'''UPDATE {facts} SET source_file_id = (SELECT id FROM source_files)
+                WHERE (SELECT COUNT(*) FROM source_files) = 1''',
+                f'CREATE INDEX IF NOT EXISTS idx_{facts}_source ON {facts} (source_file_id)',
+            ],
+            # 8: a version the writers advance with every change, which other processes'
+            # query caches compare against
+            [
+                'CREATE TABLE IF NOT EXISTS data_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)',
+                'INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)',
+            ],
+        ]
+
+    def insert_rows(self, cursor, rows, staged=None, source_id=None):
+        """
+        Insert parsed rows as facts, interning their clientid, uri and
+        mal_code, and add them to monthly_rollup and the staged mirror writes.
+        """
+        rows = list(rows)
+        position = self.position
+        clientid, mal_code, uri = position['clientid'], position['mal_code'], position['uri']
+        client_name, business_function = position['client_name'], position['business_function']
+        # Facts hold integer keys; the repeated text lives once in the dimension tables
+        clients = intern_members(cursor, 'clients', 'clientid', 'client_name',
+                                 {row[clientid]: row[client_name] for row in rows})
+        uris = intern_members(cursor, 'uris', 'uri', 'business_function',
+                              {row[uri]: row[business_function] for row in rows})
+        mal_codes = intern_members(cursor, 'mal_codes', 'mal_code', None, {row[mal_code]: None for row in rows})
+        plain = [position[name] for name in self.fact_columns]
+        cursor.executemany(f'''
+            INSERT INTO {self.facts_table} ({', '.join(self.fact_columns)}, client_key, mal_code_key, uri_key, source_file_id)
+            VALUES ({', '.join(['?'] * (len(plain) + 4))})
+        ''', [tuple(row[i] for i in plain) + (clients[row[clientid]][0], mal_codes[row[mal_code]][0], uris[row[uri]][0],
+                                                 source_id) for row in rows])
+        # Totals and the analytics mirror use the names the dimensions currently hold
+        rows = [(row[position['month_key']], row[clientid], row[mal_code], row[uri], row[position['count']],
+                 uris[row[uri]][1], clients[row[clientid]][1]) for row in rows]
+        update_rollup(cursor, rows)
+        if staged:
+            staged.append(rows)
+
+def setup_database(conn, migrations, table, store=None):
+    """
+    Apply an app's schema migrations, then seed its columnar mirror from rows
+    loaded before the backend was switched on, or refresh it after
+    migrations, which may rename clients and functions.
+    """
+    migrated = migrate_database(conn, migrations)
+    if store and (migrated or store.is_empty()):
+        with write_transaction(conn, store) as staged:
+            staged.replace_with(conn, table)
+
+def file_head_hash(csv_file, length):
+    """sha256 of the first length bytes of a file, read in HASH_BLOCK_BYTES blocks"""
+    digest = hashlib.sha256()
+    with open(csv_file, 'rb') as f:
+        while length > 0:
+            block = f.read(min(length, HASH_BLOCK_BYTES))
+            if not block:
+                break
+            digest.update(block)
+            length -= len(block)
+    return digest.hexdigest()
+
+def ends_line(csv_file, length):
+    """Whether the first length bytes of a file end with a line break"""
+    with open(csv_file, 'rb') as f:
+        f.seek(length - 1)
+        return f.read(1) == b'\n'
+
+def source_file_id(cursor, path):
+    """id of path's source_files row, adding the row if the file is new"""
+    cursor.execute('INSERT OR IGNORE INTO source_files (path) VALUES (?)', (path,))
+    return cursor.execute('SELECT id FROM source_files WHERE path = ?', (path,)).fetchone()[0]
+
+def delete_source_rows(cursor, table, facts_table, source_id, staged=None):
+    """
+    Delete the rows loaded from one source file, then recompute the rollup
+    and restage the mirror for just the months those rows were in.
+    """
+    month_keys = [row[0] for row in cursor.execute(
+        f'SELECT DISTINCT month_key FROM {facts_table} WHERE source_file_id = ? AND month_key IS NOT NULL',
+        (source_id,)).fetchall()]
+    cursor.execute(f'DELETE FROM {facts_table} WHERE source_file_id = ?', (source_id,))
+    rebuild_rollup(cursor, table, month_keys)
+    if staged:
+        staged.replace_months(cursor, table, month_keys)
+
+def record_source_file(cursor, path, fingerprint, rows, appended=False):
+    """Store a loaded file's (size, mtime_ns, head_hash) fingerprint, adding to its row count when appended"""
+    cursor.execute('''
+        INSERT INTO source_files (path, size, mtime_ns, head_hash, rows)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            size = excluded.size,
+            mtime_ns = excluded.mtime_ns,
+            head_hash = excluded.head_hash,
+            rows = CASE WHEN ? THEN rows + excluded.rows ELSE excluded.rows END
+    ''', (path,) + tuple(fingerprint) + (rows, appended))
+
+def load_csv(conn, csv_file, parse_csv_rows, schema, store=None, chunk_size=LOAD_CHUNK_SIZE):
+    """
+    Incrementally load a CSV export into a StarSchema. The file's size, mtime
+    and content hash are kept in source_files: an unchanged file is skipped, a
+    file that only grew (its old bytes unchanged and ending a line) has just
+    its new tail rows loaded, and any other change replaces the rows loaded
+    from it before, leaving other files' rows alone. Rows are streamed in
+    chunks and inserted with executemany inside a single transaction, with
+    WAL and synchronous=OFF for the duration of the load. Returns the number
+    of rows loaded.
+    """
+    path = os.path.abspath(csv_file)
+    stat = os.stat(path)
+    cursor = conn.cursor()
+    known = cursor.execute('SELECT size, mtime_ns, head_hash FROM source_files WHERE path = ?', (path,)).fetchone()
+    offset = 0
+    if known:
+        size, mtime_ns, head_hash = known
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            return 0
+        if stat.st_size > size > 0 and ends_line(path, size) and file_head_hash(path, size) == head_hash:
+            # Appended to since the last load: only the bytes past the old end are new
+            offset = size
+    total = 0
+    # Trade durability for speed during the load; the pooled default is restored
+    # after, also when the load fails, as the connection goes back to the pool
+    conn.execute('PRAGMA synchronous=OFF')
+    try:
+        with open(path, 'r', newline='') as csvfile:
+            header = next(csv.reader(csvfile))
+        with open(path, 'rb') as rawfile:
+            rawfile.seek(offset)
+            reader = csv.reader(io.TextIOWrapper(rawfile, newline=''))
+            if not offset:
+                next(reader)
+            rows = parse_csv_rows(itertools.chain([header], reader))
+            with write_transaction(conn, store) as staged:
+                source_id = source_file_id(cursor, path)
+                if known and not offset:
+                    # Rewritten in place, so the rows loaded from it earlier are stale
+                    delete_source_rows(cursor, schema.table, schema.facts_table, source_id, staged)
+                while True:
+                    chunk = list(itertools.islice(rows, chunk_size))
+                    if not chunk:
+                        break
+                    schema.insert_rows(cursor, chunk, staged, source_id)
+                    total += len(chunk)
+                fingerprint = (stat.st_size, stat.st_mtime_ns, file_head_hash(path, stat.st_size))
+                record_source_file(cursor, path, fingerprint, total, bool(offset))
+    finally:
+        conn.execute('PRAGMA synchronous=NORMAL')
+    return total